@@ -0,0 +1,83 @@
+"""
+    Parse time and peak memory of the bootstrap parser of TableauScraper2.loads2 (framed) against
+    the previous regex one, over the bootstrap responses recorded in the cache.
+
+    python benchmarks/bench_loads2.py [--cache .cache] [--repeat 5]
+"""
+import argparse
+import json
+import re
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from scrape.cache import CacheStore  # noqa: E402
+from tableau.tableau_utils import parse_framed_response  # noqa: E402
+
+
+def parse_regex(r: str) -> List[dict]:
+    data_reg = re.search(r"\d+;({.*})\d+;({.*})", r, re.DOTALL)
+    return [json.loads(data_reg.group(1)), json.loads(data_reg.group(2))]
+
+
+def find_bootstrap_responses(cache_path: Path) -> List[Tuple[str, str]]:
+    """(name, text) of every distinct bootstrap response of the cache, plus the old per-type files."""
+    store = CacheStore(cache_path)
+    found = {}
+    for entry in store.entries(event="response", tipo="initial"):
+        found.setdefault(entry["hash"], (f'{entry["ccaa"]}-{entry["screen"]}-{entry["hash"][:12]}', entry))
+
+    responses = [(name, store.get(entry["hash"], entry["codec"])) for name, entry in found.values()]
+    responses += [(path.name, path.read_text(encoding="utf-8")) for path in sorted(cache_path.glob("*-initial.json"))]
+    return responses
+
+
+def measure(parser: Callable[[str], List[dict]], text: str, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    parser(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": best, "peak_bytes": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cache", default="./.cache")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    responses = find_bootstrap_responses(Path(args.cache))
+    if len(responses) == 0:
+        print(f"No bootstrap responses found in {args.cache}")
+        return 1
+
+    failures = 0
+    print(f"{'response':<60} {'MB':>7} {'regex s':>9} {'framed s':>9} {'regex MB':>9} {'framed MB':>9}")
+    for name, text in responses:
+        if parse_framed_response(text) != parse_regex(text):
+            print(f"{name}: framed and regex parsers disagree")
+            failures += 1
+            continue
+
+        regex = measure(parse_regex, text, args.repeat)
+        framed = measure(parse_framed_response, text, args.repeat)
+        print(f"{name[-60:]:<60} {len(text) / 1e6:>7.2f} {regex['seconds']:>9.4f} {framed['seconds']:>9.4f} "
+              f"{regex['peak_bytes'] / 1e6:>9.2f} {framed['peak_bytes'] / 1e6:>9.2f}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
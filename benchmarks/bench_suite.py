@@ -0,0 +1,284 @@
+"""
+    Benchmarks of the parse and persistence hot paths over the responses recorded in the cache,
+    with no network and against a fresh SQLite database:
+
+      loads2              TableauScraper2.loads2 of every distinct bootstrap response
+      update_full_data    workbook.updateFullData of every command response, in recorded order
+      get_worksheets      dashboard.getWorksheetsCmdResponse of the same responses
+      process_variable    Scraper._process_responses of every recorded variable (what _proccess_variable
+                          runs once the page has the responses), including the database write
+      save_ws_info        Scraper._save_ws_info of every variable worksheet into empty tables
+      save_ws_unchanged   Scraper._save_ws_info again with the same worksheets (hash hit, no write)
+
+    The results are written as JSON and compared with a baseline: a benchmark slower than the
+    baseline by more than --tolerance makes the command fail.
+
+    python benchmarks/bench_suite.py [--cache .cache] [--repeat 3] [--limit N]
+                                     [--output benchmarks/results.json] [--baseline benchmarks/baseline.json]
+                                     [--save-baseline]
+"""
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# the db module opens its database when imported: point it to an empty one first
+_db_dir = tempfile.mkdtemp(prefix="bench-db-")
+atexit.register(shutil.rmtree, _db_dir, ignore_errors=True)
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(_db_dir) / 'bench.db'}"
+
+from db import db  # noqa: E402
+from db.utils import insert_all_pantallas, insert_all_provincias  # noqa: E402
+from scrape.cache import CacheStore  # noqa: E402
+from scrape.journal import read_response  # noqa: E402
+from scrape.scrape import Scraper, ScrapeResponse, ScrapeScreen  # noqa: E402
+from tableau.tableau_utils import TableauScraper2, WorkbookState  # noqa: E402
+from tableauscraper import dashboard  # noqa: E402
+
+
+class Segment:
+    """Responses of a run between two resets and the variables processed with them."""
+
+    def __init__(self):
+        self.responses: List[dict] = []
+        # (variable event, number of responses captured when it was processed)
+        self.variables: List[tuple] = []
+
+
+def load_segments(store: CacheStore, limit: Optional[int]) -> List[Segment]:
+    segments: List[Segment] = []
+    variables = 0
+    for events in store.runs().values():
+        segment = Segment()
+        for event in events:
+            if event["event"] == "reset":
+                if segment.variables:
+                    segments.append(segment)
+                kept = [r for r in segment.responses if event["keep_initial"] and r["tipo"] == ScrapeResponse.INITIAL]
+                segment = Segment()
+                segment.responses = kept
+            elif event["event"] == "response":
+                tipo = ScrapeResponse.from_string(event["tipo"])
+                if tipo is not None:
+                    segment.responses.append({"tipo": tipo, "response": read_response(store, event)})
+            elif event["event"] == "variable":
+                segment.variables.append((event, len(segment.responses)))
+                variables += 1
+                if limit is not None and variables >= limit:
+                    segments.append(segment)
+                    return segments
+        if segment.variables:
+            segments.append(segment)
+
+    return segments
+
+
+def bootstrap_responses(store: CacheStore, limit: Optional[int]) -> List[str]:
+    hashes = {}
+    for entry in store.entries(event="response", tipo=ScrapeResponse.INITIAL.value):
+        hashes.setdefault(entry["hash"], entry)
+    entries = list(hashes.values())[:limit]
+    return [read_response(store, entry) for entry in entries]
+
+
+def command_responses(segment: Segment) -> List[dict]:
+    return [json.loads(r["response"]) for r in segment.responses if r["tipo"] != ScrapeResponse.INITIAL]
+
+
+def initial_response(segment: Segment) -> Optional[str]:
+    return next((r["response"] for r in segment.responses if r["tipo"] == ScrapeResponse.INITIAL), None)
+
+
+def clear_values():
+    db.session.query(db.PantallaComunidadData).delete()
+    db.session.query(db.PantallaComunidadVariable).delete()
+    db.session.commit()
+
+
+def run(name: str, repeat: int, prepare: Callable[[], list], operation: Callable, size: int = 0) -> dict:
+    """
+        Best of `repeat` runs of `operation` over every item returned by `prepare` (not timed).
+        `size` is the number of bytes processed in each run, for the throughput.
+    """
+    best = None
+    ops = 0
+    for _ in range(repeat):
+        items = prepare()
+        ops = len(items)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for item in items:
+                operation(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {"ops": ops, "seconds": best, "ms_per_op": best * 1000 / ops if ops else 0.0}
+    if size:
+        result["mb_per_second"] = size / 1e6 / best if best else 0.0
+    print(f"{name:<20} {ops:>6} ops {best:>9.4f} s {result['ms_per_op']:>9.3f} ms/op", file=sys.stderr)
+    return result
+
+
+def bench_parse(bootstraps: List[str], segments: List[Segment], repeat: int) -> Dict[str, dict]:
+    results = {}
+    if bootstraps:
+        results["loads2"] = run(
+            "loads2", repeat, lambda: bootstraps,
+            lambda text: TableauScraper2().loads2(text),
+            sum(len(text.encode("utf-8")) for text in bootstraps),
+        )
+
+    commands = [(initial_response(segment), command_responses(segment)) for segment in segments]
+    commands = [(initial, cmds) for initial, cmds in commands if initial is not None and cmds]
+    if not commands:
+        return results
+
+    def loaded_states() -> List[tuple]:
+        # a fresh workbook per segment, every command response applied on it in order
+        items = []
+        for initial, cmds in commands:
+            state = WorkbookState()
+            state.load(initial)
+            items += [(state, cmd) for cmd in cmds]
+        return items
+
+    results["update_full_data"] = run(
+        "update_full_data", repeat, loaded_states, lambda item: item[0].workbook.updateFullData(item[1])
+    )
+    results["get_worksheets"] = run(
+        "get_worksheets", repeat, loaded_states, lambda item: dashboard.getWorksheetsCmdResponse(item[0].ts, item[1])
+    )
+    return results
+
+
+def variable_jobs(segments: List[Segment]) -> Iterator[tuple]:
+    for segment in segments:
+        for event, captured in segment.variables:
+            screen = ScrapeScreen.from_string(event["pantalla"])
+            pantalla_comunidad = db.get_pantalla_comunidad(event["pantalla"], event["comunidad"])
+            if screen is not None and pantalla_comunidad is not None:
+                yield segment, event, captured, screen, pantalla_comunidad
+
+
+def bench_persistence(segments: List[Segment], repeat: int) -> Dict[str, dict]:
+    jobs = list(variable_jobs(segments))
+    if not jobs:
+        return {}
+
+    def process_items() -> list:
+        clear_values()
+        # the workbook is kept per segment as the scraper does
+        states = {}
+        return [(job, states.setdefault(id(job[0]), WorkbookState())) for job in jobs]
+
+    def process(item):
+        (segment, event, captured, screen, pantalla_comunidad), state = item
+        Scraper._process_responses(
+            segment.responses[:captured], screen, event["modo_provincia"], pantalla_comunidad,
+            event["variable"], state, event["provincia"]
+        )
+
+    results = {"process_variable": run("process_variable", repeat, process_items, process)}
+
+    # the worksheets saved by process_variable, to time the write alone
+    worksheets = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        states = {}
+        for segment, event, captured, screen, pantalla_comunidad in jobs:
+            state = states.setdefault(id(segment), WorkbookState())
+            workbook = Scraper._update_workbook(state, segment.responses[:captured])
+            sheet = next((t for t in workbook.worksheets if t.name == screen.get_sheet_name(event["modo_provincia"])), None)
+            if sheet is not None:
+                worksheets.append((pantalla_comunidad, event["variable"], sheet,
+                                   screen.get_column_names(event["modo_provincia"]), event["provincia"]))
+
+    def save(item):
+        Scraper._save_ws_info(*item)
+
+    def empty_tables() -> list:
+        clear_values()
+        return worksheets
+
+    results["save_ws_info"] = run("save_ws_info", repeat, empty_tables, save)
+    results["save_ws_unchanged"] = run("save_ws_unchanged", repeat, lambda: worksheets, save)
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> int:
+    regressions = 0
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None or not reference.get("ms_per_op"):
+            continue
+
+        ratio = result["ms_per_op"] / reference["ms_per_op"]
+        status = "REGRESSION" if ratio > 1 + tolerance else "ok"
+        regressions += status != "ok"
+        print(f"{name:<20} {reference['ms_per_op']:>9.3f} -> {result['ms_per_op']:>9.3f} ms/op  x{ratio:.2f}  {status}",
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cache", default="./.cache")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=None, help="variables (and bootstrap responses) used at most")
+    parser.add_argument("--output", default=str(Path(__file__).parent / "results.json"))
+    parser.add_argument("--baseline", default=str(Path(__file__).parent / "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    store = CacheStore(Path(args.cache))
+    bootstraps = bootstrap_responses(store, args.limit)
+    segments = load_segments(store, args.limit)
+    if not bootstraps and not segments:
+        print(f"No recorded responses found in {args.cache}", file=sys.stderr)
+        return 1
+
+    insert_all_provincias()
+    insert_all_pantallas()
+
+    benchmarks = {**bench_parse(bootstraps, segments, args.repeat), **bench_persistence(segments, args.repeat)}
+    results = {
+        "fecha": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "fixtures": {
+            "bootstraps": len(bootstraps),
+            "variables": sum(len(segment.variables) for segment in segments),
+        },
+        "benchmarks": benchmarks,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        return 0
+
+    if not Path(args.baseline).is_file():
+        print(f"No baseline in {args.baseline}, run with --save-baseline to create it", file=sys.stderr)
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    return 1 if compare(benchmarks, baseline["benchmarks"], args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+    End-to-end throughput of main.main against the local Tableau stand-in (src/standin.py),
+    which replays the responses recorded in the cache with a configurable latency. The same
+    set of jobs is run once per concurrency level, on a fresh SQLite database, and the jobs
+    finished per minute are reported:
+
+      workers   concurrent scrapers (main.py --workers)
+      jobs      jobs processed / failed, out of --jobs
+      jobs/min  processed jobs per minute of wall time
+
+    Only the pantallas with a recorded bootstrap response are used, and every comunidad of a
+    pantalla gets the responses recorded for one of them. The scrapers record their own
+    responses in a temporary cache, the fixtures are not modified.
+
+    python benchmarks/bench_throughput.py [--cache .cache] [--workers 1,2,4] [--jobs 12]
+                                          [--engine browser|http] [--latency 0.2] [--jitter 0.1]
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# the db module opens its database when imported: point it to an empty one first
+_work_dir = tempfile.mkdtemp(prefix="bench-throughput-")
+atexit.register(shutil.rmtree, _work_dir, ignore_errors=True)
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(_work_dir) / 'bench.db'}"
+
+import main as scraper_main  # noqa: E402
+import standin  # noqa: E402
+from db import db  # noqa: E402
+from scrape.cache import CacheStore  # noqa: E402
+from scrape.scrape import ScrapeScreen  # noqa: E402
+
+
+def recorded_jobs(viz: standin.RecordedViz, limit: int) -> List[int]:
+    """Ids of the first `limit` jobs whose pantalla can be served by the stand-in."""
+    tabs = set(viz.tabs)
+    jobs = []
+    for pantalla_comunidad in db.session.query(db.PantallaComunidad).order_by(db.PantallaComunidad.id):
+        screen = ScrapeScreen.from_string(pantalla_comunidad.pantalla.nombre)
+        if screen is not None and screen.to_scrape_tab(False) in tabs:
+            jobs.append(pantalla_comunidad.id)
+            if len(jobs) >= limit:
+                break
+    return jobs
+
+
+def reset_jobs(jobs: List[int]):
+    """Leave `jobs` pending, every other job done, no values saved and the circuit breaker closed."""
+    db.session.query(db.CircuitBreakerState).delete()
+    db.session.query(db.PantallaComunidadData).delete()
+    db.session.query(db.PantallaComunidadVariable).delete()
+    db.session.query(db.PantallaComunidad).update({
+        db.PantallaComunidad.estado: db.Estado.PROCESADO,
+        db.PantallaComunidad.error_count: 0,
+        db.PantallaComunidad.lease_owner: None,
+        db.PantallaComunidad.lease_expira: None,
+        db.PantallaComunidad.next_attempt_at: None,
+    })
+    db.session.query(db.PantallaComunidad).filter(db.PantallaComunidad.id.in_(jobs)).update({
+        db.PantallaComunidad.estado: db.Estado.PENDIENTE,
+    })
+    db.session.commit()
+
+
+def count_jobs(jobs: List[int], estado: db.Estado) -> int:
+    db.session.expire_all()
+    return (
+        db.session.query(db.PantallaComunidad)
+        .filter(db.PantallaComunidad.id.in_(jobs), db.PantallaComunidad.estado == estado)
+        .count()
+    )
+
+
+async def run(args) -> List[dict]:
+    viz = standin.RecordedViz(CacheStore(Path(args.cache).resolve()))
+    if not viz.tabs:
+        print(f"No recorded bootstrap responses found in {args.cache}", file=sys.stderr)
+        return []
+
+    # the journal of the scrapers goes to ./.cache
+    os.chdir(_work_dir)
+    scraper_main.init_tables()
+    jobs = recorded_jobs(viz, args.jobs)
+
+    runner = await standin.start_server(viz, port=args.port, latency=args.latency, jitter=args.jitter,
+                                        seed=args.seed)
+    results = []
+    try:
+        for workers in args.workers:
+            reset_jobs(jobs)
+            start = time.perf_counter()
+            await scraper_main.main(
+                workers=workers,
+                engine=args.engine,
+                provincias_paralelas=args.provincias,
+                base_url=f"http://127.0.0.1:{args.port}",
+                # the failed jobs count as failed, their retries would only measure the backoff
+                wait_retries=False,
+            )
+            elapsed = time.perf_counter() - start
+
+            processed = count_jobs(jobs, db.Estado.PROCESADO)
+            result = {
+                "workers": workers,
+                "jobs": len(jobs),
+                "processed": processed,
+                "failed": len(jobs) - processed,
+                "seconds": elapsed,
+                "jobs_per_minute": processed * 60 / elapsed if elapsed else 0.0,
+            }
+            results.append(result)
+            print(f"{workers:>3} workers {processed:>4}/{len(jobs)} jobs ({result['failed']} failed) "
+                  f"{elapsed:>9.1f} s {result['jobs_per_minute']:>8.2f} jobs/min", file=sys.stderr)
+    finally:
+        await runner.cleanup()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cache", default="./.cache", help="cache directory with the recorded responses")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated concurrency levels")
+    parser.add_argument("--jobs", type=int, default=12, help="jobs run at each level")
+    parser.add_argument("--engine", choices=[scraper_main.ENGINE_BROWSER, scraper_main.ENGINE_HTTP],
+                        default=scraper_main.ENGINE_BROWSER)
+    parser.add_argument("--provincias", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds added to every VizQL response")
+    parser.add_argument("--jitter", type=float, default=0.1, help="random extra latency, up to these seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=standin.DEFAULT_PORT)
+    parser.add_argument("--output", default=str(Path(__file__).resolve().parent / "throughput.json"))
+    parser.add_argument("--verbose", action="store_true", help="show the log of the scrapers")
+    args = parser.parse_args()
+    args.workers = [int(workers) for workers in args.workers.split(",")]
+
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    results = asyncio.run(run(args))
+    if not results:
+        return 1
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump({
+            "fecha": datetime.utcnow().isoformat(),
+            "engine": args.engine,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "levels": results,
+        }, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
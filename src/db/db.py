@@ -1,18 +1,43 @@
-import sys
-from typing import List, Type, Optional
+import asyncio
+import os
+import random
+import threading
+from typing import List, Type, Optional, Callable, Sequence, Dict
 
 from sqlalchemy import create_engine, Enum, DateTime, Column, Integer, String, ForeignKey, Boolean, asc, \
-    UniqueConstraint, Text
+    UniqueConstraint, Text, and_, or_, update, inspect, text, event, Engine, Float, Index, select, func, make_url
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Mapped, Session
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, relationship, Mapped, Session, scoped_session
+from datetime import datetime, timedelta
 import enum
 
+from utils.text_utils import parse_valor
+
 
 class Estado(enum.Enum):
     PENDIENTE = "pendiente"
     PROCESADO = "procesado"
     ERROR = "error"
+    EN_CURSO = "en curso"
+
+
+# Seconds a claimed job stays owned by a worker without a heartbeat
+LEASE_SECONDS = 300
+
+# Failed attempts after which a job is not retried anymore
+MAX_ATTEMPTS = 8
+
+# A failed job is retried after RETRY_BASE_SECONDS * 2^(errors - 1) seconds (at most RETRY_MAX_SECONDS,
+# reached at the 7th error), half of it random so the jobs that failed together don't come back together
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 1800
+
+# Circuit breaker of the Tableau site, shared through the database (see CircuitBreakerState)
+CIRCUIT_NAME = "tableau"
+
+# Rows of pantalla_comunidad_valor sent in each bulk upsert statement
+UPSERT_BATCH_SIZE = 500
 
 
 Base = declarative_base()
@@ -27,7 +52,7 @@ class Comunidad(Base):
 
     provincias = relationship('Provincia', back_populates='comunidad')
     pantalla_comunidades = relationship('PantallaComunidad', back_populates='comunidad')
-    pantalla_comunidad_datas = relationship('PantallaComunidadData', back_populates='comunidad')
+    municipios = relationship('Municipio', back_populates='comunidad')
 
     def get_provincia_capital(self) -> "Provincia":
         return next((p for p in self.provincias if p.es_capital), None)
@@ -64,7 +89,7 @@ class Pantalla(Base):
     descripcion = Column(String)
 
     pantalla_comunidades = relationship('PantallaComunidad', back_populates='pantalla')
-    pantalla_comunidad_datas = relationship('PantallaComunidadData', back_populates='pantalla')
+    variables = relationship('Variable', back_populates='pantalla')
 
 
 class PantallaComunidad(Base):
@@ -77,52 +102,282 @@ class PantallaComunidad(Base):
     fecha_estado = Column(DateTime, nullable=False, default=datetime.utcnow)
     error = Column(Text, nullable=True)
     error_count = Column(Integer, nullable=False, default=0)
+    lease_owner = Column(String, nullable=True)
+    lease_expira = Column(DateTime, nullable=True)
+    # a failed job is not claimed before this time (see retry_delay)
+    next_attempt_at = Column(DateTime, nullable=True)
 
     pantalla: Mapped[Pantalla] = relationship('Pantalla', back_populates='pantalla_comunidades')
     comunidad: Mapped[Comunidad] = relationship('Comunidad', back_populates='pantalla_comunidades')
 
-    def set_procesado(self, sess: Session):
+
+def retry_delay(error_count: int) -> float:
+    """Seconds before the attempt after `error_count` failures: exponential backoff with jitter."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (error_count - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitBreakerState(Base):
+    """Until when the circuit breaker of every process sharing the database stays open."""
+    __tablename__ = 'circuit_breaker'
+
+    nombre = Column(String, primary_key=True)
+    abierto_hasta = Column(DateTime, nullable=True)
+
+
+class Municipio(Base):
+    __tablename__ = 'municipios'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    id_comunidad = Column(Integer, ForeignKey('comunidades.id'), nullable=False)
+    nombre = Column(String, nullable=False)
+
+    comunidad = relationship('Comunidad', back_populates='municipios')
+
+    __table_args__ = (
+        UniqueConstraint('id_comunidad', 'nombre', name='uix_municipio_comunidad_nombre'),
+    )
+
+
+class Variable(Base):
+    __tablename__ = 'variables'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    id_pantalla = Column(Integer, ForeignKey('pantallas.id'), nullable=False)
+    nombre = Column(String, nullable=False)
+
+    pantalla = relationship('Pantalla', back_populates='variables')
+
+    __table_args__ = (
+        UniqueConstraint('id_pantalla', 'nombre', name='uix_variable_pantalla_nombre'),
+    )
+
+
+class PantallaComunidadData(Base):
+    """Value of a variable for a municipio: the label shown by Tableau and its number and unit."""
+    __tablename__ = 'pantalla_comunidad_valor'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    id_municipio = Column(Integer, ForeignKey('municipios.id'), nullable=False)
+    id_variable = Column(Integer, ForeignKey('variables.id'), nullable=False)
+    valor = Column(String)
+    valor_num = Column(Float)
+    unidad = Column(String)
+    # last time valor changed, see PantallaComunidadVariable.fecha_verificado for the last check
+    fecha_descarga = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    municipio = relationship('Municipio')
+    variable = relationship('Variable')
+
+    __table_args__ = (
+        UniqueConstraint('id_municipio', 'id_variable', name='uix_municipio_variable'),
+        # aggregates of a variable (sum, avg, ranking...) read only the index
+        Index('ix_variable_valor_num', 'id_variable', 'valor_num'),
+    )
+
+
+class PantallaComunidadVariable(Base):
+    """
+        A variable of a PantallaComunidad (of one of its provincias in provincial mode): progress of the
+        scrape (estado, intentos), hash of the last worksheet saved for it, when it last changed and
+        when it was last checked.
+    """
+    __tablename__ = 'pantalla_comunidad_variable'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    id_pantalla_comunidad = Column(Integer, ForeignKey('pantalla_comunidad.id'), nullable=False)
+    id_variable = Column(Integer, ForeignKey('variables.id'), nullable=False)
+    # nombre of the provincia in provincial mode, '' for the whole comunidad
+    provincia = Column(String, nullable=False, default='')
+    estado = Column(Enum(Estado, native_enum=False), nullable=False, default=Estado.PENDIENTE)
+    intentos = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    hash = Column(String(64), nullable=True)
+    fecha_cambio = Column(DateTime, nullable=True)
+    fecha_verificado = Column(DateTime, nullable=True)
+
+    pantalla_comunidad = relationship('PantallaComunidad')
+    variable = relationship('Variable')
+
+    __table_args__ = (
+        UniqueConstraint('id_pantalla_comunidad', 'id_variable', 'provincia', name='uix_pantalla_comunidad_variable'),
+    )
+
+    def set_en_curso(self, sess: Session):
+        self.estado = Estado.EN_CURSO
+        self.intentos = (self.intentos or 0) + 1
+        sess.add(self)
+
+    def set_verificado(self, sess: Session, payload_hash: str):
+        now = datetime.utcnow()
+        if self.hash != payload_hash:
+            self.hash = payload_hash
+            self.fecha_cambio = now
+        self.fecha_verificado = now
         self.estado = Estado.PROCESADO
-        self.fecha_estado = datetime.utcnow()
         self.error = None
         sess.add(self)
 
     def set_error(self, sess: Session, mensaje: str):
         self.estado = Estado.ERROR
-        self.fecha_estado = datetime.utcnow()
         self.error = mensaje
-        self.error_count += 1
         sess.add(self)
 
 
-class PantallaComunidadData(Base):
-    __tablename__ = 'pantalla-comunidad-data'
+# Free-text table used before municipios and variables were normalized, see migrate_legacy_data()
+LEGACY_DATA_TABLE = 'pantalla-comunidad-data'
+# ...renamed to this once migrated, as a backup
+LEGACY_BACKUP_TABLE = 'pantalla-comunidad-data-backup'
+
+
+# Pragmas applied to every new SQLite connection, by storage profile
+STORAGE_PROFILES = {
+    # sqlite defaults: rollback journal and synchronous=FULL, only the busy timeout is set
+    "default": {
+        "busy_timeout": 30000,
+    },
+    # readers don't block the writer and several processes can share the file
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,  # KiB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 30000,  # ms
+    },
+}
+
+# Connections kept open in the pool of a database file. Every task (worker, job, provincia) holds
+# the connection of its session across awaits, so past these the pool opens as many as needed
+# instead of blocking the event loop until a connection is returned
+POOL_SIZE = 5
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///database.db")
+DATABASE_PROFILE = os.environ.get("DATABASE_PROFILE", "wal")
+
+
+def create_sqlite_engine(url: str = DATABASE_URL, profile: str = DATABASE_PROFILE) -> Engine:
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile {profile}, expected one of {list(STORAGE_PROFILES)}")
+
+    pragmas = STORAGE_PROFILES[profile]
+    pool_args = {}
+    if make_url(url).database not in (None, "", ":memory:"):
+        pool_args = {"pool_size": POOL_SIZE, "max_overflow": -1}
+    new_engine = create_engine(
+        url,
+        echo=False,
+        connect_args={"timeout": pragmas.get("busy_timeout", 5000) / 1000},
+        **pool_args,
+    )
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    id_pantalla = Column(Integer, ForeignKey('pantallas.id'))
-    id_comunidad = Column(Integer, ForeignKey('comunidades.id'))
-    municipio = Column(String, nullable=False)
-    nombre = Column(String, nullable=False)
-    valor = Column(String)
-    fecha_descarga = Column(DateTime, nullable=False, default=datetime.utcnow)
+    @event.listens_for(new_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
 
-    # Relación con las otras tablas
-    pantalla = relationship('Pantalla', back_populates='pantalla_comunidad_datas')
-    comunidad = relationship('Comunidad', back_populates='pantalla_comunidad_datas')
+    return new_engine
 
-    # Agregar la restricción UNIQUE
-    __table_args__ = (
-        UniqueConstraint('id_pantalla', 'id_comunidad', 'municipio', 'nombre', name='uix_pantalla_comunidad_nombre'),
-    )
+
+def _session_scope():
+    """Each asyncio task (worker) gets its own session, plain code one per thread."""
+    try:
+        return asyncio.current_task() or threading.get_ident()
+    except RuntimeError:
+        return threading.get_ident()
 
 
 # Crear motor y sesión
-engine = create_engine('sqlite:///database.db', echo=False)
+engine = create_sqlite_engine()
 Session = sessionmaker(bind=engine)
-session = Session()
+# Session of the current worker: call session.remove() when the worker ends
+session = scoped_session(Session, scopefunc=_session_scope)
+
+
+def add_missing_columns():
+    """
+        create_all() doesn't touch existing tables, so add the columns declared in the models
+        that an older database.db doesn't have yet.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+
+
+def has_legacy_data() -> bool:
+    return inspect(engine).has_table(LEGACY_DATA_TABLE)
+
+
+def migrate_legacy_data(batch_size: int = 10000) -> bool:
+    """
+        Copy the rows of the old free-text `pantalla-comunidad-data` table to municipios, variables
+        and pantalla_comunidad_valor (parsing valor_num and unidad from the label), then rename it
+        to LEGACY_BACKUP_TABLE. Run with `python src/migrate.py`. Returns False if there was nothing
+        to migrate.
+    """
+    with engine.connect() as conn:
+        # take the write lock first: another process migrating at the same time waits here and
+        # then finds the table already renamed
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        if not inspect(conn).has_table(LEGACY_DATA_TABLE):
+            conn.rollback()
+            return False
+
+        conn.execute(text(
+            f'INSERT OR IGNORE INTO municipios (id_comunidad, nombre) '
+            f'SELECT DISTINCT id_comunidad, municipio FROM "{LEGACY_DATA_TABLE}"'
+        ))
+        conn.execute(text(
+            f'INSERT OR IGNORE INTO variables (id_pantalla, nombre) '
+            f'SELECT DISTINCT id_pantalla, nombre FROM "{LEGACY_DATA_TABLE}"'
+        ))
+        legacy_rows = conn.execute(text(
+            f'SELECT m.id, v.id, d.valor, d.fecha_descarga FROM "{LEGACY_DATA_TABLE}" d '
+            f'JOIN municipios m ON m.id_comunidad = d.id_comunidad AND m.nombre = d.municipio '
+            f'JOIN variables v ON v.id_pantalla = d.id_pantalla AND v.nombre = d.nombre'
+        ))
+        insert_valor = text(
+            'INSERT OR REPLACE INTO pantalla_comunidad_valor '
+            '(id_municipio, id_variable, valor, valor_num, unidad, fecha_descarga) '
+            'VALUES (:id_municipio, :id_variable, :valor, :valor_num, :unidad, :fecha_descarga)'
+        )
+        while True:
+            batch = legacy_rows.fetchmany(batch_size)
+            if len(batch) == 0:
+                break
+
+            rows = []
+            for id_municipio, id_variable, valor, fecha_descarga in batch:
+                valor_num, unidad = parse_valor(valor)
+                rows.append({
+                    "id_municipio": id_municipio,
+                    "id_variable": id_variable,
+                    "valor": valor,
+                    "valor_num": valor_num,
+                    "unidad": unidad,
+                    "fecha_descarga": fecha_descarga,
+                })
+            conn.execute(insert_valor, rows)
+
+        conn.execute(text(f'ALTER TABLE "{LEGACY_DATA_TABLE}" RENAME TO "{LEGACY_BACKUP_TABLE}"'))
+        conn.commit()
+
+    return True
+
 
 # Crear las tablas en la base de datos (si no existen)
 Base.metadata.create_all(engine)
+add_missing_columns()
 
 
 def update_or_create_comunidad(codigo: str, nombre: str) -> Comunidad:
@@ -209,32 +464,125 @@ def update_or_create_pantalla_comunidad(pantalla: Pantalla, comunidad: Type[Comu
     return pantalla_comunidad
 
 
-def update_or_create_pantalla_comunidad_data(pantalla: Pantalla, comunidad: Comunidad, municipio: str, variable: str, value: str) -> (
-        PantallaComunidadData):
-    pantalla_comunidad_data = session.query(PantallaComunidadData).filter_by(
-        pantalla=pantalla,
-        comunidad=comunidad,
-        municipio=municipio,
-        nombre=variable,
+def get_pantalla_comunidad(pantalla_nombre: str, comunidad_codigo: str) -> Optional[PantallaComunidad]:
+    return (
+        session.query(PantallaComunidad)
+        .join(PantallaComunidad.pantalla)
+        .join(PantallaComunidad.comunidad)
+        .filter(Pantalla.nombre == pantalla_nombre)
+        .filter(Comunidad.codigo == comunidad_codigo)
+        .first()
+    )
+
+
+def get_or_create_variable(pantalla: Pantalla, nombre: str) -> int:
+    """Id of the variable `nombre` of `pantalla`, inserted if it doesn't exist yet."""
+    session.execute(
+        sqlite_insert(Variable).values(id_pantalla=pantalla.id, nombre=nombre).on_conflict_do_nothing()
+    )
+    return session.execute(
+        select(Variable.id).where(Variable.id_pantalla == pantalla.id).where(Variable.nombre == nombre)
+    ).scalar_one()
+
+
+def get_or_create_municipios(comunidad: Comunidad, nombres: Sequence[str]) -> Dict[str, int]:
+    """Ids of the municipios `nombres` of `comunidad`, inserting the missing ones."""
+    session.execute(
+        sqlite_insert(Municipio).on_conflict_do_nothing(),
+        [{"id_comunidad": comunidad.id, "nombre": nombre} for nombre in set(nombres)],
+    )
+    return dict(session.execute(
+        select(Municipio.nombre, Municipio.id).where(Municipio.id_comunidad == comunidad.id)
+    ).tuples().all())
+
+
+def get_or_create_pantalla_comunidad_variable(pantalla_comunidad: PantallaComunidad, variable: str,
+                                              provincia: Optional[str] = None) -> PantallaComunidadVariable:
+    id_variable = get_or_create_variable(pantalla_comunidad.pantalla, variable)
+    pantalla_comunidad_variable = session.query(PantallaComunidadVariable).filter_by(
+        id_pantalla_comunidad=pantalla_comunidad.id,
+        id_variable=id_variable,
+        provincia=provincia or '',
     ).first()
-    if pantalla_comunidad_data:
-        pantalla_comunidad_data.municipio = municipio
-        pantalla_comunidad_data.nombre = variable
-        pantalla_comunidad_data.valor = value
-        pantalla_comunidad_data.fecha_descarga = datetime.utcnow()
-    else:
-        pantalla_comunidad_data = PantallaComunidadData(
-            pantalla=pantalla,
-            comunidad=comunidad,
-            municipio=municipio,
-            nombre=variable,
-            valor=value,
-            fecha_descarga=datetime.utcnow(),
+    if pantalla_comunidad_variable is None:
+        pantalla_comunidad_variable = PantallaComunidadVariable(
+            id_pantalla_comunidad=pantalla_comunidad.id,
+            id_variable=id_variable,
+            provincia=provincia or '',
         )
+        session.add(pantalla_comunidad_variable)
+
+    return pantalla_comunidad_variable
+
+
+def get_pending_variables(pantalla_comunidad: PantallaComunidad, variables: List[str],
+                          provincia: Optional[str] = None) -> List[str]:
+    """
+        The `variables` (in their order) not processed yet in this run of `pantalla_comunidad`, so a
+        retried job resumes where it failed (see claim_pending_pantalla for when a run starts).
+    """
+    procesadas = {
+        nombre for (nombre,) in session.query(Variable.nombre)
+        .join(PantallaComunidadVariable, PantallaComunidadVariable.id_variable == Variable.id)
+        .filter(PantallaComunidadVariable.id_pantalla_comunidad == pantalla_comunidad.id)
+        .filter(PantallaComunidadVariable.provincia == (provincia or ''))
+        .filter(PantallaComunidadVariable.estado == Estado.PROCESADO)
+    }
+    return [variable for variable in variables if variable not in procesadas]
+
+
+def bulk_upsert_pantalla_comunidad_data(
+        pantalla: Pantalla,
+        comunidad: Comunidad,
+        variable: str,
+        municipios: Sequence[str],
+        valores: Sequence[str],
+        batch_size: int = UPSERT_BATCH_SIZE,
+) -> int:
+    """
+        Insert or update the values of `variable` for every municipio with one
+        INSERT ... ON CONFLICT DO UPDATE per batch, on the uix_municipio_variable constraint.
+        Rows whose valor, valor_num and unidad didn't change are left untouched. It doesn't commit.
+        Returns the number of rows sent.
+    """
+    if len(municipios) == 0:
+        return 0
+
+    id_variable = get_or_create_variable(pantalla, variable)
+    id_municipios = get_or_create_municipios(comunidad, municipios)
+    fecha_descarga = datetime.utcnow()
+    rows = []
+    for municipio, valor in zip(municipios, valores):
+        valor_num, unidad = parse_valor(valor)
+        rows.append({
+            "id_municipio": id_municipios[municipio],
+            "id_variable": id_variable,
+            "valor": valor,
+            "valor_num": valor_num,
+            "unidad": unidad,
+            "fecha_descarga": fecha_descarga,
+        })
+
+    statement = sqlite_insert(PantallaComunidadData)
+    statement = statement.on_conflict_do_update(
+        index_elements=["id_municipio", "id_variable"],
+        set_={
+            "valor": statement.excluded.valor,
+            "valor_num": statement.excluded.valor_num,
+            "unidad": statement.excluded.unidad,
+            "fecha_descarga": statement.excluded.fecha_descarga,
+        },
+        where=or_(
+            PantallaComunidadData.valor.is_distinct_from(statement.excluded.valor),
+            PantallaComunidadData.valor_num.is_distinct_from(statement.excluded.valor_num),
+            PantallaComunidadData.unidad.is_distinct_from(statement.excluded.unidad),
+        ),
+    )
 
-        session.add(pantalla_comunidad_data)
-    sys.stdout.flush()
-    return pantalla_comunidad_data
+    for start in range(0, len(rows), batch_size):
+        session.execute(statement, rows[start:start + batch_size])
+
+    return len(rows)
 
 
 # Función de ejemplo para obtener y mostrar todas las provincias
@@ -244,13 +592,174 @@ def mostrar_provincias():
         print(f"Provincia: {provincia.nombre}, Capital: {provincia.es_capital}")
 
 
-def get_pending_pantalla() -> Optional[PantallaComunidad]:
-    pantalla_comunidad = (
-        session.query(PantallaComunidad)
-        .filter(PantallaComunidad.estado != Estado.PROCESADO)
-        .filter(PantallaComunidad.error_count < 3)
-        .order_by(asc(PantallaComunidad.fecha_estado))
-        .first()
+def _claimable_pantalla(now: datetime):
+    return and_(
+        PantallaComunidad.error_count < MAX_ATTEMPTS,
+        or_(PantallaComunidad.next_attempt_at.is_(None), PantallaComunidad.next_attempt_at <= now),
+        or_(
+            PantallaComunidad.estado.in_([Estado.PENDIENTE, Estado.ERROR]),
+            and_(
+                PantallaComunidad.estado == Estado.EN_CURSO,
+                or_(PantallaComunidad.lease_expira.is_(None), PantallaComunidad.lease_expira < now),
+            ),
+        ),
     )
 
-    return pantalla_comunidad
+
+def claim_pending_pantalla(
+        owner: str,
+        lease_seconds: int = LEASE_SECONDS,
+        cost: Optional[Callable[[PantallaComunidad], int]] = None,
+) -> Optional[PantallaComunidad]:
+    """
+        Atomically take a pending job (or one whose lease has expired) for `owner`.
+        Candidates are tried by `cost` (the caller's cheapest transition first) and then by
+        oldest fecha_estado. The claim is a compare-and-set UPDATE, so two processes sharing
+        the database can't get the same PantallaComunidad.
+        A job claimed from PENDIENTE starts a new run: the variable checkpoints of the previous
+        one are reset. A failed job, or one released or whose lease expired, keeps them and resumes.
+    """
+    while True:
+        now = datetime.utcnow()
+        candidates = (
+            session.query(PantallaComunidad)
+            .filter(_claimable_pantalla(now))
+            .order_by(asc(PantallaComunidad.fecha_estado))
+            .all()
+        )
+        if len(candidates) == 0:
+            return None
+
+        if cost is not None:
+            candidates.sort(key=cost)
+
+        for candidate in candidates:
+            with engine.begin() as conn:
+                result = conn.execute(
+                    update(PantallaComunidad)
+                    .where(PantallaComunidad.id == candidate.id)
+                    .where(PantallaComunidad.estado == candidate.estado)
+                    .where(_claimable_pantalla(now))
+                    .values(
+                        estado=Estado.EN_CURSO,
+                        fecha_estado=now,
+                        lease_owner=owner,
+                        lease_expira=now + timedelta(seconds=lease_seconds),
+                    )
+                )
+                if result.rowcount == 1 and candidate.estado == Estado.PENDIENTE:
+                    conn.execute(
+                        update(PantallaComunidadVariable)
+                        .where(PantallaComunidadVariable.id_pantalla_comunidad == candidate.id)
+                        .values(estado=Estado.PENDIENTE, intentos=0, error=None)
+                    )
+
+            if result.rowcount == 1:
+                session.refresh(candidate)
+                return candidate
+            # another worker claimed it first, try with the next one
+
+        # every candidate was taken in the meantime, look again
+        session.expire_all()
+
+
+def get_next_attempt() -> Optional[datetime]:
+    """When the next failed job waiting for its retry can be claimed, None if there is none."""
+    return (
+        session.query(func.min(PantallaComunidad.next_attempt_at))
+        .filter(PantallaComunidad.estado == Estado.ERROR)
+        .filter(PantallaComunidad.error_count < MAX_ATTEMPTS)
+        .scalar()
+    )
+
+
+def get_circuit_open_until(nombre: str = CIRCUIT_NAME) -> Optional[datetime]:
+    with engine.connect() as conn:
+        return conn.execute(
+            select(CircuitBreakerState.abierto_hasta).where(CircuitBreakerState.nombre == nombre)
+        ).scalar()
+
+
+def set_circuit_open_until(abierto_hasta: datetime, nombre: str = CIRCUIT_NAME):
+    """Open the shared breaker until `abierto_hasta`, unless it is already open for longer."""
+    statement = sqlite_insert(CircuitBreakerState).values(nombre=nombre, abierto_hasta=abierto_hasta)
+    with engine.begin() as conn:
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[CircuitBreakerState.nombre],
+            set_={"abierto_hasta": statement.excluded.abierto_hasta},
+            where=or_(
+                CircuitBreakerState.abierto_hasta.is_(None),
+                CircuitBreakerState.abierto_hasta < statement.excluded.abierto_hasta,
+            ),
+        ))
+
+
+def heartbeat_pantalla(pantalla_comunidad_id: int, owner: str, lease_seconds: int = LEASE_SECONDS) -> bool:
+    """Extend the lease of a claimed job. Returns False if the lease no longer belongs to `owner`."""
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(PantallaComunidad)
+            .where(PantallaComunidad.id == pantalla_comunidad_id)
+            .where(PantallaComunidad.estado == Estado.EN_CURSO)
+            .where(PantallaComunidad.lease_owner == owner)
+            .values(lease_expira=datetime.utcnow() + timedelta(seconds=lease_seconds))
+        )
+
+    return result.rowcount == 1
+
+
+def set_pantalla_procesada(pantalla_comunidad: PantallaComunidad, owner: str) -> bool:
+    """Finish a claimed job. Returns False (and changes nothing) if the lease no longer belongs to `owner`."""
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(PantallaComunidad)
+            .where(PantallaComunidad.id == pantalla_comunidad.id)
+            .where(PantallaComunidad.estado == Estado.EN_CURSO)
+            .where(PantallaComunidad.lease_owner == owner)
+            .values(estado=Estado.PROCESADO, fecha_estado=datetime.utcnow(), error=None,
+                    lease_owner=None, lease_expira=None, next_attempt_at=None)
+        )
+
+    session.expire(pantalla_comunidad)
+    return result.rowcount == 1
+
+
+def set_pantalla_error(pantalla_comunidad: PantallaComunidad, owner: str, mensaje: str,
+                       count_attempt: bool = True) -> bool:
+    """
+        Mark a claimed job as failed, to be retried after retry_delay. Returns False (and changes
+        nothing) if the lease no longer belongs to `owner`.
+        `count_attempt` False doesn't use up one of the MAX_ATTEMPTS of the job (it failed while the
+        upstream was down, see utils.circuit_breaker), but the retry is still delayed.
+    """
+    now = datetime.utcnow()
+    # error_count doesn't change while the job is owned
+    error_count = pantalla_comunidad.error_count + (1 if count_attempt else 0)
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(PantallaComunidad)
+            .where(PantallaComunidad.id == pantalla_comunidad.id)
+            .where(PantallaComunidad.estado == Estado.EN_CURSO)
+            .where(PantallaComunidad.lease_owner == owner)
+            .values(estado=Estado.ERROR, fecha_estado=now, error=mensaje, error_count=error_count,
+                    lease_owner=None, lease_expira=None,
+                    next_attempt_at=now + timedelta(seconds=retry_delay(max(1, error_count))))
+        )
+
+    session.expire(pantalla_comunidad)
+    return result.rowcount == 1
+
+
+def release_pantalla(pantalla_comunidad_id: int, owner: str):
+    """
+        Give back a claimed job that was not finished, so any worker can take it right away. Its
+        lease is expired, not the job reset to PENDIENTE, so the next claim resumes its variables.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            update(PantallaComunidad)
+            .where(PantallaComunidad.id == pantalla_comunidad_id)
+            .where(PantallaComunidad.estado == Estado.EN_CURSO)
+            .where(PantallaComunidad.lease_owner == owner)
+            .values(lease_owner=None, lease_expira=datetime.utcnow())
+        )
@@ -0,0 +1,223 @@
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Connection, func, select
+
+from db import db
+
+# Rows read from the database and written to parquet at a time
+CHUNK_SIZE = 50000
+
+# Last fecha_descarga exported of every partition, kept in the output directory
+STATE_FILE = "_export_state.json"
+
+LAYOUT_LONG = "long"
+LAYOUT_WIDE = "wide"
+
+LONG_SCHEMA = pa.schema([
+    ("municipio", pa.string()),
+    ("variable", pa.string()),
+    ("valor", pa.string()),
+    ("valor_num", pa.float64()),
+    ("unidad", pa.string()),
+    ("fecha_descarga", pa.timestamp("us")),
+])
+
+
+class Partition:
+    """The values of one pantalla and one comunidad: a `pantalla=<nombre>/comunidad=<codigo>` directory."""
+
+    def __init__(self, pantalla: db.Pantalla, comunidad: db.Comunidad, fecha_descarga: datetime, rows: int):
+        self.pantalla = pantalla
+        self.comunidad = comunidad
+        self.fecha_descarga = fecha_descarga
+        self.rows = rows
+
+    @property
+    def key(self) -> str:
+        return f"{self.pantalla.id}/{self.comunidad.id}"
+
+    def path(self, output_path: Path) -> Path:
+        # hive style, readable with pyarrow.dataset / pandas.read_parquet(output_path)
+        return output_path / f"pantalla={quote(self.pantalla.nombre)}" / f"comunidad={quote(self.comunidad.codigo)}"
+
+
+def find_partitions(conn: Connection) -> List[Partition]:
+    pantallas = {pantalla.id: pantalla for pantalla in db.session.query(db.Pantalla)}
+    comunidades = {comunidad.id: comunidad for comunidad in db.session.query(db.Comunidad)}
+
+    result = conn.execute(
+        select(
+            db.Variable.id_pantalla,
+            db.Municipio.id_comunidad,
+            func.max(db.PantallaComunidadData.fecha_descarga),
+            func.count(),
+        )
+        .join(db.PantallaComunidadData.variable)
+        .join(db.PantallaComunidadData.municipio)
+        .group_by(db.Variable.id_pantalla, db.Municipio.id_comunidad)
+    )
+
+    return [
+        Partition(pantallas[id_pantalla], comunidades[id_comunidad], fecha_descarga, rows)
+        for id_pantalla, id_comunidad, fecha_descarga, rows in result
+    ]
+
+
+def iter_values(conn: Connection, partition: Partition, chunk_size: int) -> Iterator[List[tuple]]:
+    """(municipio, variable, valor, valor_num, unidad, fecha_descarga) of the partition, by municipio, in chunks."""
+    result = conn.execution_options(yield_per=chunk_size).execute(
+        select(
+            db.Municipio.nombre,
+            db.Variable.nombre,
+            db.PantallaComunidadData.valor,
+            db.PantallaComunidadData.valor_num,
+            db.PantallaComunidadData.unidad,
+            db.PantallaComunidadData.fecha_descarga,
+        )
+        .join(db.PantallaComunidadData.variable)
+        .join(db.PantallaComunidadData.municipio)
+        .where(db.Variable.id_pantalla == partition.pantalla.id)
+        .where(db.Municipio.id_comunidad == partition.comunidad.id)
+        .order_by(db.Municipio.nombre, db.Variable.nombre)
+    )
+
+    for rows in result.partitions():
+        yield rows
+
+
+def long_batches(conn: Connection, partition: Partition, chunk_size: int) -> Iterator[pa.RecordBatch]:
+    for rows in iter_values(conn, partition, chunk_size):
+        columns = list(zip(*rows))
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, LONG_SCHEMA)],
+            schema=LONG_SCHEMA,
+        )
+
+
+def wide_schema(variables: List[str]) -> pa.Schema:
+    return pa.schema([("municipio", pa.string())] + [(variable, pa.float64()) for variable in variables])
+
+
+def wide_batches(conn: Connection, partition: Partition, variables: List[str],
+                 chunk_size: int) -> Iterator[pa.RecordBatch]:
+    """
+        One row per municipio and one valor_num column per variable. The values come ordered by
+        municipio, so a row is complete as soon as the next municipio shows up: only one chunk
+        of rows is kept in memory.
+    """
+    schema = wide_schema(variables)
+    column_index = {variable: i for i, variable in enumerate(variables)}
+    municipios: List[str] = []
+    values: List[List[Optional[float]]] = []
+    current: Optional[Tuple[str, List[Optional[float]]]] = None
+
+    def flush() -> pa.RecordBatch:
+        arrays = [pa.array(municipios, type=pa.string())]
+        arrays += [pa.array([row[i] for row in values], type=pa.float64()) for i in range(len(variables))]
+        batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+        municipios.clear()
+        values.clear()
+        return batch
+
+    for rows in iter_values(conn, partition, chunk_size):
+        for municipio, variable, _, valor_num, _, _ in rows:
+            if current is None or current[0] != municipio:
+                if current is not None:
+                    municipios.append(current[0])
+                    values.append(current[1])
+                current = (municipio, [None] * len(variables))
+            current[1][column_index[variable]] = valor_num
+
+        if len(municipios) >= chunk_size:
+            yield flush()
+
+    if current is not None:
+        municipios.append(current[0])
+        values.append(current[1])
+    if municipios:
+        yield flush()
+
+
+def export_partition(conn: Connection, partition: Partition, output_path: Path, layout: str, chunk_size: int):
+    if layout == LAYOUT_WIDE:
+        variables = sorted(variable.nombre for variable in partition.pantalla.variables)
+        schema = wide_schema(variables)
+        batches = wide_batches(conn, partition, variables, chunk_size)
+    else:
+        schema = LONG_SCHEMA
+        batches = long_batches(conn, partition, chunk_size)
+
+    path = partition.path(output_path)
+    os.makedirs(path, exist_ok=True)
+    # write next to the final file and rename, readers never see a partial partition
+    tmp_file = path / "part-0.parquet.tmp"
+    with pq.ParquetWriter(tmp_file, schema, compression="zstd") as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    os.replace(tmp_file, path / "part-0.parquet")
+
+
+def load_state(output_path: Path, layout: str) -> Dict[str, str]:
+    state_path = output_path / STATE_FILE
+    if not state_path.is_file():
+        return {}
+
+    with open(state_path, "r", encoding="utf-8") as file:
+        state = json.load(file)
+
+    # a different layout needs every partition written again
+    return state.get("partitions", {}) if state.get("layout") == layout else {}
+
+
+def save_state(output_path: Path, layout: str, partitions: Dict[str, str]):
+    with open(output_path / STATE_FILE, "w", encoding="utf-8") as file:
+        json.dump({"layout": layout, "partitions": partitions}, file, indent=2)
+
+
+def export(output_path: Path, layout: str = LAYOUT_LONG, changed_only: bool = False, chunk_size: int = CHUNK_SIZE):
+    """
+        Write the scraped values as parquet, partitioned by pantalla and comunidad. With
+        `changed_only`, partitions whose last fecha_descarga is the one already exported are skipped.
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(output_path, exist_ok=True)
+    state = load_state(output_path, layout) if changed_only else {}
+
+    with db.engine.connect() as conn:
+        for partition in find_partitions(conn):
+            fecha_descarga = partition.fecha_descarga.isoformat()
+            if state.get(partition.key) == fecha_descarga:
+                logger.info(f"{partition.pantalla.nombre} / {partition.comunidad.nombre} not changed, skipping")
+                continue
+
+            logger.info(f"Exporting {partition.pantalla.nombre} / {partition.comunidad.nombre}: {partition.rows} values")
+            export_partition(conn, partition, output_path, layout, chunk_size)
+            state[partition.key] = fecha_descarga
+            save_state(output_path, layout, state)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the scraped values to parquet, by pantalla and comunidad")
+    parser.add_argument("--output", default="./export", help="output directory")
+    parser.add_argument("--layout", choices=[LAYOUT_LONG, LAYOUT_WIDE], default=LAYOUT_LONG,
+                        help="one row per value, or one row per municipio with a column per variable")
+    parser.add_argument("--changed", action="store_true",
+                        help="only write the partitions with values downloaded since the last export")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows read and written at a time")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    args = parse_args()
+    export(Path(args.output), args.layout, args.changed, args.chunk_size)
@@ -1,16 +1,25 @@
+import argparse
 import asyncio
 import io
 import logging
+import os
+import socket
 import sys
-import time
 import traceback
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Optional, Union
 
 import pandas as pd
 import scrape.scrape
+import scrape.vizql
 from db.utils import insert_all_pantallas, insert_all_provincias
 from db import db
 from scrape.exception import ScrapeError, ScrapeNoWorksheetsAfterLoad, ScrapeNoVariableProcessed
 from playwright._impl._errors import Error as PlaywrightError
+from playwright.async_api import async_playwright
+from utils import metrics
+from utils.circuit_breaker import CircuitBreaker
 
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 pd.set_option('display.max_rows', None)
@@ -19,69 +28,339 @@ pd.set_option('display.max_rows', None)
 #pd.set_option('display.max_colwidth', None)
 #pd.set_option('display.width', 0)
 
+ENGINE_BROWSER = "browser"
+ENGINE_HTTP = "http"
+
+ScraperType = Union[scrape.scrape.Scraper, scrape.vizql.HttpScraper]
+
 
 def init_tables():
     insert_all_provincias()
     insert_all_pantallas()
+    if db.has_legacy_data():
+        logging.getLogger(__name__).warning(
+            f"Values in the old '{db.LEGACY_DATA_TABLE}' table, move them with python src/migrate.py"
+        )
+
 
+async def heartbeat(pantalla_comunidad_id: int, owner: str, lease_seconds: int, logger: logging.Logger,
+                    job: asyncio.Task, lease_lost: asyncio.Event):
+    """Extend the lease of the job while `job` scrapes it. If the lease is lost `job` is cancelled."""
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        if not db.heartbeat_pantalla(pantalla_comunidad_id, owner, lease_seconds):
+            logger.warning(f"Lease lost for pantalla_comunidad {pantalla_comunidad_id}, abandoning the job")
+            lease_lost.set()
+            job.cancel()
+            return
 
-async def main():
+
+async def run_leased(job: Awaitable, pantalla_comunidad_id: int, owner: str, lease_seconds: int,
+                     logger: logging.Logger) -> bool:
     """
-        Split the job in small pieces. A job is a CCAA and one of these:
-        Demografía, Medio Físico, Economío, Servicios, Vivienda, Medioambiente.
-        So in the
-    :return:
+        Run `job` in its own task while a heartbeat keeps the lease of the job alive. Returns False
+        if the lease was lost and `job` cancelled. The heartbeat is stopped before returning, so
+        the state of the job can be changed afterwards without it interfering.
     """
-    init_tables()
+    job_task = asyncio.ensure_future(job)
+    lease_lost = asyncio.Event()
+    heartbeat_task = asyncio.create_task(heartbeat(
+        pantalla_comunidad_id, owner, lease_seconds, logger, job_task, lease_lost
+    ))
+    try:
+        await job_task
+    except asyncio.CancelledError:
+        if not lease_lost.is_set():
+            raise
+        return False
+    finally:
+        heartbeat_task.cancel()
+        await asyncio.gather(heartbeat_task, return_exceptions=True)
+
+    return True
+
 
-    # obtener una pantalla pendiente
-    pantalla_comunidad = db.get_pending_pantalla()
+async def scrape_provincias(
+        pantalla_comunidad: db.PantallaComunidad,
+        scraper: ScraperType,
+        browser: Optional[scrape.scrape.SharedBrowser],
+        new_scraper: Callable[[], ScraperType],
+        parallel: int,
+        logger: logging.Logger,
+):
+    """
+        Provincial fallback: scrape the provincias of the comunidad with up to `parallel` scrapers
+        at once, `scraper` plus new ones on the same browser. Once all of them have finished the
+        first error is raised, so the job is only processed if every provincia succeeds.
+    """
+    provincias: asyncio.Queue = asyncio.Queue()
+    for provincia in pantalla_comunidad.comunidad.provincias:
+        provincias.put_nowait(provincia)
+
+    async def scrape_next(provincial_scraper: ScraperType, start: bool):
+        try:
+            # the extra scrapers load the viz in their own task, while the others already scrape
+            if start:
+                await provincial_scraper.start(browser)
+            while not provincias.empty():
+                provincia = provincias.get_nowait()
+                logger.info(f"Scrapeando provincia {provincia.nombre}")
+                await provincial_scraper.scrape(pantalla_comunidad, provincia)
+        finally:
+            # every task has its own session (see db._session_scope)
+            db.session.remove()
+
+    extra_scrapers = [new_scraper() for _ in range(min(parallel, provincias.qsize()) - 1)]
+    try:
+        results = await asyncio.gather(
+            scrape_next(scraper, False),
+            *(scrape_next(extra_scraper, True) for extra_scraper in extra_scrapers),
+            return_exceptions=True,
+        )
+    finally:
+        for extra_scraper in extra_scrapers:
+            await extra_scraper.finalize()
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if len(errors) > 0:
+        raise errors[0]
+
+
+async def worker(
+        worker_id: int,
+        browser: Optional[scrape.scrape.SharedBrowser],
+        new_scraper: Callable[[], ScraperType],
+        lease_seconds: int = db.LEASE_SECONDS,
+        provincias_paralelas: int = 1,
+        metrics_path: Optional[Path] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        wait_retries: bool = True,
+):
+    """
+        Claim pending jobs one by one and scrape them with its own scraper (a BrowserContext
+        of `browser`, or an HTTP session for the browserless engine).
+        The lease on the job is kept alive with a heartbeat while scraping; if it is lost (another
+        worker reclaimed the job) the job is abandoned without touching its state. After an error
+        the scraper is recovered (see Scraper.recover) instead of being thrown away, and the
+        job is retried later with backoff (see db.retry_delay): once no job is ready the worker
+        waits for the next retry, or ends if `wait_retries` is False. `breaker` holds every worker
+        while the upstream is failing. The phase timings are written to `metrics_path` after every job.
+    """
+    logger = logging.getLogger(f"{__name__}.worker-{worker_id}")
+    owner = f"{socket.gethostname()}:{os.getpid()}:{worker_id}"
+    breaker = breaker or CircuitBreaker()
     scraper = None
 
     try:
-        while pantalla_comunidad is not None:
-            logging.info(
+        while True:
+            await breaker.wait()
+            # prefer the job this scraper can reach with the fewest page transitions
+            pantalla_comunidad = db.claim_pending_pantalla(
+                owner, lease_seconds, scraper.transition_cost if scraper is not None else None
+            )
+            if pantalla_comunidad is None:
+                breaker.release()
+                next_attempt = db.get_next_attempt()
+                if next_attempt is None or not wait_retries:
+                    break
+
+                delay = max(0.0, (next_attempt - datetime.utcnow()).total_seconds())
+                logger.info(f"No job ready, next retry in {delay:.0f} s")
+                await asyncio.sleep(delay)
+                continue
+
+            logger.info(
                 f"Scrapeando pantalla: {pantalla_comunidad.pantalla.nombre}, comunidad: {pantalla_comunidad.comunidad.nombre}")
 
-            if scraper is None:
-                scraper = scrape.scrape.Scraper()
-                await scraper.start()
+            async def run_job():
+                nonlocal scraper
+                try:
+                    if scraper is None:
+                        scraper = new_scraper()
+                        await scraper.start(browser)
+
+                    try:
+                        await scraper.scrape(pantalla_comunidad)
+                    except ScrapeNoWorksheetsAfterLoad:
+                        logger.info("Intentando provincia a provincia")
+                        await scrape_provincias(
+                            pantalla_comunidad, scraper, browser, new_scraper, provincias_paralelas, logger
+                        )
+                finally:
+                    # the job runs in its own task, with its own session (see db._session_scope)
+                    db.session.remove()
 
-            try:
+            with metrics.tags(pantalla=pantalla_comunidad.pantalla.nombre, comunidad=pantalla_comunidad.comunidad.nombre), \
+                    metrics.span("job"):
                 try:
-                    await scraper.scrape(pantalla_comunidad)
-                    pantalla_comunidad.set_procesado(db.session)
-                    db.session.commit()
-                except ScrapeNoWorksheetsAfterLoad as scrape_error:
-                    logging.info("Intentando provincia a provincia")
-                    for provincia in pantalla_comunidad.comunidad.provincias:
-
-                        await scraper.scrape(pantalla_comunidad, provincia)
-
-                    pantalla_comunidad.set_procesado(db.session)
-                    db.session.commit()
-            except (ScrapeNoVariableProcessed, ScrapeNoWorksheetsAfterLoad) as scrape_error:
-                logging.error(f"Scrape error: {scrape_error}")
-                raise
-            except (ScrapeError, PlaywrightError) as scrape_error:
-                logging.error(f"Scrape error: {scrape_error}")
-                pantalla_comunidad.set_error(db.session, traceback.format_exc())
-                db.session.commit()
-                await scraper.screenshot(path="pagina_completa.png", full_page=True)
-                # await db.set_pantalla_provincia_error(pantalla_provincia, scrape_error)
-                await scraper.finalize()
-                scraper = None
-            # break
-            time.sleep(5)
-            pantalla_comunidad = db.get_pending_pantalla()
-        #
+                    if await run_leased(run_job(), pantalla_comunidad.id, owner, lease_seconds, logger):
+                        if not db.set_pantalla_procesada(pantalla_comunidad, owner):
+                            logger.warning(f"Lease lost for pantalla_comunidad {pantalla_comunidad.id}, not marked as processed")
+                        breaker.record(True)
+                    elif scraper is not None:
+                        # abandoned halfway through: the job belongs to another worker now
+                        await scraper.finalize()
+                        scraper = None
+                except (ScrapeNoVariableProcessed, ScrapeNoWorksheetsAfterLoad) as scrape_error:
+                    logger.error(f"Scrape error: {scrape_error}")
+                    raise
+                except (ScrapeError, PlaywrightError) as scrape_error:
+                    logger.error(f"Scrape error: {scrape_error}")
+                    # a job failing while the breaker is open or probing doesn't use up an attempt
+                    if not db.set_pantalla_error(pantalla_comunidad, owner, traceback.format_exc(),
+                                                 count_attempt=breaker.closed):
+                        logger.warning(f"Lease lost for pantalla_comunidad {pantalla_comunidad.id}, error not recorded")
+                    breaker.record(False)
+                    if scraper is not None:
+                        if scraper.page is not None:
+                            try:
+                                await scraper.screenshot(path=f"pagina_completa-{worker_id}.png", full_page=True)
+                            except PlaywrightError as screenshot_error:
+                                logger.warning(f"Screenshot error: {screenshot_error}")
+                        # await db.set_pantalla_provincia_error(pantalla_provincia, scrape_error)
+                        try:
+                            await scraper.recover()
+                        except (ScrapeError, PlaywrightError) as recover_error:
+                            logger.error(f"Recover error: {recover_error}")
+                            await scraper.finalize()
+                            scraper = None
+                finally:
+                    # no-op if the job was finished, otherwise other workers can take it right away
+                    db.release_pantalla(pantalla_comunidad.id, owner)
+                    # a probe job that ended without an outcome (abandoned, fatal error) gives back its slot
+                    breaker.release()
+            if metrics_path is not None:
+                metrics.registry.write(metrics_path)
     finally:
         if scraper is not None:
             await scraper.finalize()
+        # close the session of this worker (see db._session_scope)
+        db.session.remove()
+
+
+def scraper_factory(
+        engine: str,
+        block_resources: bool = True,
+        verbose: bool = False,
+        base_url: str = scrape.scrape.BASE_URL,
+) -> Callable[[], ScraperType]:
+    if engine == ENGINE_HTTP:
+        return lambda: scrape.vizql.HttpScraper(viz_url=scrape.vizql.viz_url(base_url))
+
+    return lambda: scrape.scrape.Scraper(
+        route_filter=scrape.scrape.default_route_filter(base_url) if block_resources else None,
+        verbose=verbose,
+        base_url=base_url,
+    )
+
+
+async def run_workers(
+        workers: int,
+        browser: Optional[scrape.scrape.SharedBrowser],
+        new_scraper: Callable[[], ScraperType],
+        lease_seconds: int,
+        provincias_paralelas: int = 1,
+        metrics_path: Optional[Path] = None,
+        wait_retries: bool = True,
+):
+    # one breaker for the pool, its open state shared with the other processes of the database:
+    # when the upstream fails every worker stops
+    breaker = CircuitBreaker(load_open_until=db.get_circuit_open_until, save_open_until=db.set_circuit_open_until)
+    tasks = [
+        asyncio.create_task(worker(
+            worker_id, browser, new_scraper, lease_seconds, provincias_paralelas, metrics_path, breaker,
+            wait_retries
+        ))
+        for worker_id in range(workers)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # a fatal error in one worker stops the whole pool
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(
+        workers: int = 1,
+        lease_seconds: int = db.LEASE_SECONDS,
+        headless: bool = True,
+        block_resources: bool = True,
+        engine: str = ENGINE_BROWSER,
+        verbose: bool = False,
+        provincias_paralelas: int = 1,
+        metrics_path: Optional[Path] = None,
+        base_url: str = scrape.scrape.BASE_URL,
+        wait_retries: bool = True,
+):
+    """
+        Split the job in small pieces. A job is a CCAA and one of these:
+        Demografía, Medio Físico, Economío, Servicios, Vivienda, Medioambiente.
+        Jobs are shared by a pool of `workers` scrapers, each one with its own
+        BrowserContext inside a single Chromium (or its own HTTP session with the
+        browserless engine). Jobs are leased in the database, so several processes
+        can share the same database.db (DATABASE_URL / DATABASE_PROFILE, see db.STORAGE_PROFILES).
+        With `wait_retries` False it returns once no job is ready, leaving the failed ones for a later run.
+    :return:
+    """
+    init_tables()
+    new_scraper = scraper_factory(engine, block_resources, verbose, base_url)
+
+    if engine == ENGINE_HTTP:
+        await run_workers(workers, None, new_scraper, lease_seconds, provincias_paralelas, metrics_path,
+                          wait_retries)
+        return
+
+    async with async_playwright() as playwright:
+        browser = scrape.scrape.SharedBrowser(playwright, headless)
+        try:
+            await run_workers(workers, browser, new_scraper, lease_seconds, provincias_paralelas, metrics_path,
+                              wait_retries)
+        finally:
+            await browser.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scrape Sistema Integrado de Datos Municipales")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of scrapers (BrowserContexts) running concurrently")
+    parser.add_argument("--engine", choices=[ENGINE_BROWSER, ENGINE_HTTP], default=ENGINE_BROWSER,
+                        help="drive the viz with Chromium or issue the VizQL commands over plain HTTP")
+    parser.add_argument("--base-url", default=scrape.scrape.BASE_URL,
+                        help="Tableau server with the viz, e.g. a local stand-in (python src/standin.py)")
+    parser.add_argument("--lease", type=int, default=db.LEASE_SECONDS,
+                        help="seconds a claimed job is kept without a heartbeat before other workers reclaim it")
+    parser.add_argument("--no-wait-retries", action="store_true",
+                        help="exit once no job is ready instead of waiting for the backoff of the failed ones")
+    parser.add_argument("--provincias", type=int, default=3,
+                        help="provincias scraped at once (extra BrowserContexts) when a CCAA view has no worksheets")
+    parser.add_argument("--headed", action="store_true",
+                        help="show the browser window (needs a display, e.g. Xvfb)")
+    parser.add_argument("--no-block", action="store_true",
+                        help="load every resource of the viz instead of blocking images, fonts and third-party hosts")
+    parser.add_argument("--metrics", default="./metrics",
+                        help="directory for the Prometheus text file and JSON summary of the phase timings")
+    parser.add_argument("--verbose", action="store_true",
+                        help="log the captured requests in the browser console")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
     logging.basicConfig()
     logging.getLogger().setLevel(logging.INFO)
-    asyncio.run(main())
+    args = parse_args()
+    asyncio.run(main(
+        workers=args.workers,
+        lease_seconds=args.lease,
+        headless=not args.headed,
+        block_resources=not args.no_block,
+        engine=args.engine,
+        verbose=args.verbose,
+        provincias_paralelas=args.provincias,
+        metrics_path=Path(args.metrics),
+        base_url=args.base_url,
+        wait_retries=not args.no_wait_retries,
+    ))
     # db.mostrar_provincias()
 
@@ -0,0 +1,22 @@
+import argparse
+import logging
+
+from db import db
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=f"Move the values of the old '{db.LEGACY_DATA_TABLE}' table to the normalized tables"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows copied at a time")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    args = parse_args()
+    if db.migrate_legacy_data(args.batch_size):
+        logging.info(f"Legacy values migrated, the old table is kept as '{db.LEGACY_BACKUP_TABLE}'")
+    else:
+        logging.info(f"No '{db.LEGACY_DATA_TABLE}' table, nothing to migrate")
@@ -0,0 +1,92 @@
+import argparse
+import io
+import logging
+import sys
+from pathlib import Path
+from typing import List
+
+from db import db
+from db.utils import insert_all_pantallas, insert_all_provincias
+from scrape.exception import ScrapeError
+from scrape.cache import CacheStore
+from scrape.journal import read_response
+from scrape.scrape import Scraper, ScrapeResponse, ScrapeScreen
+from tableau.tableau_utils import WorkbookState
+from tableauscraper.TableauScraper import TableauException
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+
+def replay_run(store: CacheStore, run_id: str, events: List[dict]) -> int:
+    """
+        Rebuild the data of a recorded run without a browser: the journal events are applied
+        in the same order the scraper saw them and every processed variable is saved again.
+        Only the values are written: the variable checkpoints (and their fecha_verificado) are
+        left as they are, nothing has been checked against the site.
+    :return: number of variables saved
+    """
+    logger = logging.getLogger(__name__)
+    responses: List[dict] = []
+    state = WorkbookState()
+    saved = 0
+
+    for event in events:
+        if event["event"] == "reset":
+            responses = [
+                response for response in responses
+                if event["keep_initial"] and response["tipo"] == ScrapeResponse.INITIAL
+            ]
+            state.reset()
+        elif event["event"] == "response":
+            scrape_response = ScrapeResponse.from_string(event["tipo"])
+            if scrape_response is not None:
+                responses.append({
+                    'tipo': scrape_response,
+                    'response': read_response(store, event),
+                })
+        elif event["event"] == "variable":
+            screen = ScrapeScreen.from_string(event["pantalla"])
+            pantalla_comunidad = db.get_pantalla_comunidad(event["pantalla"], event["comunidad"])
+            if screen is None or pantalla_comunidad is None:
+                logger.warning(f"Unknown pantalla {event['pantalla']} / comunidad {event['comunidad']}, skipping")
+                continue
+
+            try:
+                Scraper._process_responses(
+                    responses, screen, event["modo_provincia"], pantalla_comunidad, event["variable"], state,
+                    event["provincia"], checkpoint=False
+                )
+                saved += 1
+            except (ScrapeError, TableauException) as scrape_error:
+                db.session.rollback()
+                logger.error(f"Replay error in {run_id} #{event['seq']} {event['variable']}: {scrape_error}")
+
+    return saved
+
+
+def replay(cache_path: Path, run_ids: List[str]):
+    insert_all_provincias()
+    insert_all_pantallas()
+    store = CacheStore(cache_path)
+
+    for run_id, events in store.runs().items():
+        if run_ids and run_id not in run_ids:
+            continue
+
+        logging.info(f"Replaying run {run_id}")
+        saved = replay_run(store, run_id, events)
+        logging.info(f"Run {run_id}: {saved} variables saved")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rebuild the database from the responses recorded in the cache")
+    parser.add_argument("--cache", default="./.cache", help="cache directory used by the scraper")
+    parser.add_argument("runs", nargs="*", help="run ids to replay (all of them, oldest first, by default)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    args = parse_args()
+    replay(Path(args.cache), args.runs)
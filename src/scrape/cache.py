@@ -0,0 +1,116 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is used without it
+    zstandard = None
+
+MANIFEST_FILE = "manifest.jsonl"
+OBJECTS_DIR = "objects"
+
+CODEC_GZIP = "gzip"
+CODEC_ZSTD = "zstd"
+
+_EXTENSIONS = {CODEC_GZIP: ".gz", CODEC_ZSTD: ".zst"}
+
+
+class CacheStore:
+    """
+        Content-addressed store of the captured Tableau responses.
+
+        Each response is saved once, compressed, in `objects/<hash[:2]>/<hash>.json.<gz|zst>`, where hash
+        is the sha256 of its text. `manifest.jsonl` keeps one line per journal event (responses, resets,
+        processed variables) with its run, sequence, timestamp, ccaa, provincia, screen, variable and type,
+        so replay and debugging tools can find any response.
+    """
+
+    def __init__(self, cache_path: Path, codec: Optional[str] = None):
+        self.cache_path = Path(cache_path)
+        if codec is None:
+            codec = CODEC_ZSTD if zstandard is not None else CODEC_GZIP
+        if codec == CODEC_ZSTD and zstandard is None:
+            raise ValueError("zstd codec needs the zstandard package")
+        if codec not in _EXTENSIONS:
+            raise ValueError(f"Unknown codec {codec}")
+        self.codec = codec
+        os.makedirs(self.cache_path / OBJECTS_DIR, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.cache_path / MANIFEST_FILE
+
+    def object_path(self, content_hash: str, codec: str) -> Path:
+        return self.cache_path / OBJECTS_DIR / content_hash[:2] / f"{content_hash}.json{_EXTENSIONS[codec]}"
+
+    def put(self, text: str) -> Tuple[str, str]:
+        """Store `text` if it isn't stored yet. Returns its hash and the codec it is stored with."""
+        data = text.encode("utf-8")
+        content_hash = hashlib.sha256(data).hexdigest()
+        for codec in (self.codec, *(c for c in _EXTENSIONS if c != self.codec)):
+            if self.object_path(content_hash, codec).is_file():
+                return content_hash, codec
+
+        path = self.object_path(content_hash, self.codec)
+        os.makedirs(path.parent, exist_ok=True)
+        # write to a temporary file and rename, so readers never see a partial object
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(self._compress(data))
+        os.replace(tmp_path, path)
+
+        return content_hash, self.codec
+
+    def get(self, content_hash: str, codec: str) -> str:
+        with open(self.object_path(content_hash, codec), "rb") as file:
+            return self._decompress(file.read(), codec).decode("utf-8")
+
+    def append(self, entry: dict):
+        # a single write per line, so several processes can append to the same manifest
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with open(self.manifest_path, "a", encoding="utf-8") as file:
+            file.write(line)
+
+    def entries(self, **filters) -> Iterator[dict]:
+        """Manifest entries, in order, whose fields match `filters` (e.g. ccaa=..., tipo="set_param")."""
+        if not self.manifest_path.is_file():
+            return
+
+        with open(self.manifest_path, "r", encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if all(entry.get(key) == value for key, value in filters.items()):
+                    yield entry
+
+    def runs(self) -> Dict[str, List[dict]]:
+        """Journal events grouped by run, runs oldest first (run ids start with their UTC timestamp)."""
+        runs: Dict[str, List[dict]] = OrderedDict()
+        for entry in self.entries():
+            runs.setdefault(entry["run_id"], []).append(entry)
+
+        for events in runs.values():
+            events.sort(key=lambda event: event["seq"])
+
+        return OrderedDict(sorted(runs.items()))
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.codec == CODEC_ZSTD:
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return gzip.compress(data, compresslevel=6)
+
+    @classmethod
+    def _decompress(cls, data: bytes, codec: str) -> bytes:
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise ValueError("zstd codec needs the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
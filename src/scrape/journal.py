@@ -0,0 +1,45 @@
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from scrape.cache import CacheStore
+
+
+class ResponseJournal:
+    """
+        Ordered record of a scraper run in the cache manifest: every captured response, the resets
+        of the response list and the variables processed with them, so the run can be replayed
+        without a browser. The responses themselves go to the content-addressed store.
+    """
+
+    def __init__(self, store: CacheStore, run_id: Optional[str] = None):
+        self.store = store
+        self.run_id = run_id or f"{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.seq = 0
+
+    def response(self, tipo: str, response_text: str, **context) -> str:
+        content_hash, codec = self.store.put(response_text)
+        self._write({"event": "response", "tipo": tipo, "hash": content_hash, "codec": codec, **context})
+        return content_hash
+
+    def reset(self, keep_initial: bool):
+        self._write({"event": "reset", "keep_initial": keep_initial})
+
+    def variable(self, variable: str, pantalla: str, comunidad: str, modo_provincia: bool,
+                 provincia: Optional[str] = None):
+        self._write({
+            "event": "variable",
+            "variable": variable,
+            "pantalla": pantalla,
+            "comunidad": comunidad,
+            "provincia": provincia,
+            "modo_provincia": modo_provincia,
+        })
+
+    def _write(self, event: dict):
+        self.seq += 1
+        self.store.append({"run_id": self.run_id, "seq": self.seq, "fecha": datetime.utcnow().isoformat(), **event})
+
+
+def read_response(store: CacheStore, event: dict) -> str:
+    return store.get(event["hash"], event["codec"])
@@ -0,0 +1,57 @@
+import logging
+from typing import Iterable
+from urllib.parse import urlparse
+
+from playwright.async_api import BrowserContext, Route
+
+# Hosts the viz needs to load (subdomains included)
+DEFAULT_ALLOWED_HOSTS = ("tableau.com",)
+
+# Playwright resource types the scraper never needs: map tiles, pictures, fonts...
+DEFAULT_BLOCKED_RESOURCE_TYPES = ("image", "media", "font")
+
+
+class RouteFilter:
+    """
+        Route interception for a BrowserContext. Requests to third-party hosts and
+        non-essential resource types are aborted, except the urls matching `always_allowed`
+        (the VizQL endpoints the scraper captures), which are let through.
+    """
+
+    def __init__(
+            self,
+            allowed_hosts: Iterable[str] = DEFAULT_ALLOWED_HOSTS,
+            blocked_resource_types: Iterable[str] = DEFAULT_BLOCKED_RESOURCE_TYPES,
+            always_allowed: Iterable[str] = (),
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.allowed_hosts = tuple(host.lower() for host in allowed_hosts)
+        self.blocked_resource_types = frozenset(blocked_resource_types)
+        self.always_allowed = tuple(always_allowed)
+        self.blocked_count = 0
+
+    def is_allowed(self, url: str, resource_type: str) -> bool:
+        if any(pattern in url for pattern in self.always_allowed):
+            return True
+
+        if resource_type in self.blocked_resource_types:
+            return False
+
+        host = (urlparse(url).hostname or "").lower()
+        if not host:
+            # data:, blob:, about: ...
+            return True
+
+        return any(host == allowed or host.endswith("." + allowed) for allowed in self.allowed_hosts)
+
+    async def install(self, context: BrowserContext):
+        await context.route("**/*", self._handle)
+
+    async def _handle(self, route: Route):
+        request = route.request
+        if self.is_allowed(request.url, request.resource_type):
+            await route.continue_()
+        else:
+            self.blocked_count += 1
+            self.logger.debug(f"Blocked {request.resource_type} {request.url}")
+            await route.abort()
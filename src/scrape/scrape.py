@@ -1,17 +1,25 @@
 import asyncio
 import enum
+import hashlib
 import json
 import logging
 import os
 import sys
 from pathlib import Path
 from typing import List, Optional, TypedDict
-from playwright.async_api import async_playwright, Page, Browser, BrowserContext, FrameLocator, Locator
-from tableauscraper import dashboard, TableauWorksheet
+from urllib.parse import urlparse
+from playwright._impl._errors import Error as PlaywrightError
+from playwright.async_api import async_playwright, Page, Browser, BrowserContext, FrameLocator, Locator, Playwright
+from tableauscraper import TableauWorksheet, TableauWorkbook
 from scrape.exception import ScrapeTimeoutError, ScrapeError, ScrapeNoWorksheetsAfterLoad, ScrapeNoVariableProcessed
-from tableau.tableau_utils import TableauScraper2
+from scrape import timeouts
+from scrape.cache import CacheStore
+from scrape.journal import ResponseJournal
+from scrape.network import DEFAULT_ALLOWED_HOSTS, RouteFilter
+from tableau.tableau_utils import WorkbookState
 from db import db
-from utils.text_utils import fix_mojibake
+from utils import metrics
+from utils.text_utils import fix_mojibake_series
 
 
 class ColumnNames(TypedDict):
@@ -35,6 +43,22 @@ class ScrapeResponse(enum.Enum):
             return None
 
 
+# Where the viz is loaded from: the public site, or a stand-in server (see standin.py) for offline runs
+BASE_URL = os.environ.get("TABLEAU_BASE_URL", "https://public.tableau.com")
+
+# Path of the workbook in the Tableau Public profile, the sheet (tab) name is appended
+WORKBOOK_PATH = "/app/profile/reto.demografico/viz/SistemaIntegradodeDatosMunicipales2023"
+
+# VizQL endpoints whose responses are captured in the page
+RESPONSE_URLS = {
+    ScrapeResponse.INITIAL: 'bootstrapSession/sessions/',
+    ScrapeResponse.FIRST_RENDER: '/notify-first-client-render-occurred',
+    ScrapeResponse.SET_PARAM: '/set-parameter-value-from-index',
+    ScrapeResponse.NEW_LAYOUT: '/ensure-layout-for-sheet',
+    ScrapeResponse.CATEGORICAL: '/categorical-filter-by-index',
+}
+
+
 class ScrapeScreen(enum.Enum):
     DEMOGRAFIA = "Demografía"
     MEDIOFISICO = "Medio Físico"
@@ -251,20 +275,127 @@ class ScrapeTab(enum.Enum):
             return None
 
 
+async def launch_browser(playwright: Playwright, headless: bool = True) -> Browser:
+    return await playwright.chromium.launch(
+        headless=headless,
+        args=["--disable-gpu", "--disable-dev-shm-usage"] if headless else None,
+    )
+
+
+def sheet_url_name(tab: ScrapeTab) -> str:
+    """Tableau drops the non ascii characters of the sheet name in its url: B1_Demográfico_CCAA -> B1_Demogrfico_CCAA"""
+    return tab.value.encode("ascii", "ignore").decode("ascii")
+
+
+class SharedBrowser:
+    """Chromium shared by the scrapers of a worker pool, relaunched when it dies."""
+
+    def __init__(self, playwright: Playwright, headless: bool = True):
+        self.playwright = playwright
+        self.headless = headless
+        self.browser: Optional[Browser] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> Browser:
+        async with self._lock:
+            if self.browser is None or not self.browser.is_connected():
+                self.browser = await launch_browser(self.playwright, self.headless)
+            return self.browser
+
+    async def relaunch(self, broken: Optional[Browser]) -> Browser:
+        """
+            Relaunch the browser if `broken` is really disconnected and no other scraper replaced it
+            yet. A browser still connected is kept: closing it would kill every context of the pool.
+        """
+        async with self._lock:
+            if broken is not None and broken.is_connected():
+                raise ScrapeError("Browser still connected, not relaunching it")
+            if self.browser is None or self.browser is broken:
+                await self._close()
+                self.browser = await launch_browser(self.playwright, self.headless)
+            return self.browser
+
+    async def close(self):
+        async with self._lock:
+            await self._close()
+
+    async def _close(self):
+        if self.browser is not None:
+            try:
+                await self.browser.close()
+            except PlaywrightError:
+                pass
+            self.browser = None
+
+
+# Relative cost of the page transitions a job may need (see Scraper.transition_cost)
+COST_CATEGORICAL = 1  # _move_to_provincia
+COST_NEW_LAYOUT = 10  # _move_to_screen
+COST_NAVIGATION = 100  # _switch_to_ccaa / _switch_to_provincia
+
+
+class RecoveryTier(enum.Enum):
+    RESYNC = "resync"
+    RELOAD = "reload"
+    NEW_CONTEXT = "new_context"
+    RELAUNCH = "relaunch"
+
+
+# Counters of the recoveries done by every scraper of the process, per tier
+RECOVERY_METRIC = "scraper_recoveries_total"
+RECOVERY_FAILED_METRIC = "scraper_recovery_failures_total"
+
+# Timeouts, in seconds, of the waits with no learned timeout yet and cap of the widened ones (see scrape.timeouts)
+RESPONSE_TIMEOUT = 120
+SELECTOR_TIMEOUT = 5
+
+
+def default_route_filter(base_url: str = BASE_URL) -> RouteFilter:
+    """Block non-essential resources but always let the captured VizQL endpoints through."""
+    return RouteFilter(
+        allowed_hosts=DEFAULT_ALLOWED_HOSTS + (urlparse(base_url).hostname,),
+        always_allowed=RESPONSE_URLS.values(),
+    )
+
+
 class Scraper:
-    def __init__(self, cache_path: str = "./.cache"):
+    def __init__(
+            self,
+            cache_path: str = "./.cache",
+            headless: bool = True,
+            route_filter: Optional[RouteFilter] = None,
+            verbose: bool = False,
+            base_url: str = BASE_URL,
+    ):
         self.logger = logging.getLogger(__name__)
+        self.headless = headless
+        self.base_url = base_url.rstrip("/")
+        # console logging of the capture script in the page
+        self.verbose = verbose
+        # None loads every resource of the page
+        self.route_filter = route_filter
         self.last_responses_found = []
+        self.workbook_state = WorkbookState()
         self.playwright = None
         self.browser: Optional[Browser] = None
         self.context: Optional[BrowserContext] = None
         self.page: Optional[Page] = None
+        self.owns_browser: bool = False
+        self.shared_browser: Optional[SharedBrowser] = None
+        self._response_event: Optional[asyncio.Event] = None
+        # fallback polling period (seconds) in case a notification is missed
+        self.poll_interval: float = 3
         self.current_ccaa: Optional[str] = None
         self.modo_provincia: bool = False
         self.current_provincia: Optional[str] = None
         self.current_screen: Optional[str] = None
+        # variable being selected, recorded with the responses it triggers
+        self.selected_variable: Optional[str] = None
         self.cache_path = Path(cache_path)
         os.makedirs(self.cache_path, exist_ok=True)
+        self.journal = ResponseJournal(CacheStore(self.cache_path))
+        # learned from the latencies of previous waits, shared by the scrapers of the process
+        self.timeouts = timeouts.shared(self.cache_path)
 
     async def screenshot(self, path: str, full_page: bool = False):
         if self.page is None:
@@ -272,29 +403,147 @@ class Scraper:
 
         await self.page.screenshot(path=path, full_page=full_page)
 
-    async def start(self):
-        self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(headless=False)
+    async def start(self, shared_browser: Optional["SharedBrowser"] = None):
+        """
+            Open a new BrowserContext and load the CCAA view. When a shared browser is given the
+            context is created inside it (worker pool); otherwise the scraper launches and
+            owns its own Chromium.
+        """
+        if shared_browser is None:
+            self.playwright = await async_playwright().start()
+            shared_browser = SharedBrowser(self.playwright, self.headless)
+            self.owns_browser = True
+        else:
+            self.owns_browser = False
+        self.shared_browser = shared_browser
+
+        await self._open_context()
+        await self._switch_to_ccaa()
+        await self._close_cookies()
+        self.logger.info("Cookies closed.")
+
+    async def _open_context(self):
+        self.browser = await self.shared_browser.get()
         self.context = await self.browser.new_context(
             bypass_csp=True,  # Opcional: Ignorar la política de seguridad de contenido
             ignore_https_errors=True,  # Opcional: Ignorar errores de HTTPS
         )
+        if self.route_filter is not None:
+            await self.route_filter.install(self.context)
+        self._response_event = asyncio.Event()
+        # the init script calls it as soon as a response is captured, so waiters wake up right away
+        await self.context.expose_binding("__scraperNotify", self._on_response_captured)
         self.page = await self.context.new_page()
         self._reset_last_responses()
-        await self.page.add_init_script(INIT_SCRIPT)
+        await self.page.add_init_script(build_init_script(self.verbose, capture_host=urlparse(self.base_url).netloc))
+
+    async def _close_context(self):
+        if self.context:
+            try:
+                await self.context.close()
+            except PlaywrightError as error:
+                self.logger.warning(f"Error closing context: {error}")
+            self.context = None
+            self.page = None
+
+    async def finalize(self):
+        await self._close_context()
+        if self.owns_browser:
+            if self.shared_browser:
+                await self.shared_browser.close()
+            if self.playwright:
+                await self.playwright.stop()
+        self.shared_browser = None
+        self.browser = None
+        self.playwright = None
+
+    @metrics.timed("recover")
+    async def recover(self) -> RecoveryTier:
+        """
+            Bring the scraper back to a usable state after an error with the cheapest tier
+            that works: re-sync the page, reload it, recreate the context and, as a last
+            resort, relaunch the browser. Raises ScrapeError if every tier fails.
+        """
+        tiers = (
+            (RecoveryTier.RESYNC, self._resync),
+            (RecoveryTier.RELOAD, self._reload),
+            (RecoveryTier.NEW_CONTEXT, self._recreate_context),
+            (RecoveryTier.RELAUNCH, self._relaunch_browser),
+        )
+        for tier, action in tiers:
+            try:
+                await action()
+            except (ScrapeError, PlaywrightError) as error:
+                metrics.registry.inc(RECOVERY_FAILED_METRIC, tier=tier.value)
+                self.logger.warning(f"Recovery {tier.value} failed: {error}")
+                continue
+
+            metrics.registry.inc(RECOVERY_METRIC, tier=tier.value)
+            self.logger.info(f"Recovered with {tier.value}")
+            return tier
+
+        raise ScrapeError("Unable to recover the scraper")
+
+    async def _resync(self):
+        if self.page is None or self.page.is_closed():
+            raise ScrapeError("Page is closed")
+
+        # close any menu left open and take the responses that arrived after the error
+        await self.page.keyboard.press("Escape")
+        await self._check_new_data(self.page)
+        if await self.get_current_screen() is None:
+            raise ScrapeError("Unknown screen found in page")
+        if await self.get_current_municipio() is None:
+            raise ScrapeError("Municipio can't be found")
+
+    async def _reload(self):
+        if self.page is None or self.page.is_closed():
+            raise ScrapeError("Page is closed")
+
+        if self.modo_provincia:
+            await self._switch_to_provincia()
+        else:
+            await self._switch_to_ccaa()
+        await self._close_cookies()
+
+    async def _recreate_context(self):
+        await self._close_context()
+        await self._open_context()
         await self._switch_to_ccaa()
         await self._close_cookies()
-        self.logger.info("Cookies closed.")
 
-    async def finalize(self):
-        if self.context:
-            await self.context.close()
-        if self.browser:
-            await self.browser.close()
-        if self.playwright:
-            await self.playwright.stop()
+    async def _relaunch_browser(self):
+        # fails if the browser is alive: the problem is this scraper's, which the worker then finalizes
+        await self.shared_browser.relaunch(self.browser)
+        await self._recreate_context()
+
+    def transition_cost(self, pantalla_comunidad: db.PantallaComunidad) -> int:
+        """
+            Round-trips needed to go from what the page shows now to `pantalla_comunidad`,
+            so the scheduler can pick the cheapest pending job for this scraper.
+        """
+        if self.page is None:
+            return 0
+
+        cost = 0
+        if self.modo_provincia:
+            # jobs start in CCAA mode: full navigation
+            cost += COST_NAVIGATION
+        if self.modo_provincia or pantalla_comunidad.pantalla.nombre != self.current_screen:
+            cost += COST_NEW_LAYOUT
+        if pantalla_comunidad.comunidad.nombre != self.current_ccaa:
+            cost += COST_CATEGORICAL
+
+        return cost
 
     async def scrape(self, pantalla_comunidad: db.PantallaComunidad, provincia: Optional[db.Provincia] = None):
+        with metrics.tags(provincia=provincia.nombre if provincia else None), metrics.span("scrape"):
+            try:
+                await self._scrape(pantalla_comunidad, provincia)
+            finally:
+                self.timeouts.save()
+
+    async def _scrape(self, pantalla_comunidad: db.PantallaComunidad, provincia: Optional[db.Provincia] = None):
         if self.modo_provincia and provincia is None:
             await self._switch_to_ccaa()
         elif (not self.modo_provincia) and provincia is not None:
@@ -337,39 +586,60 @@ class Scraper:
             await self._wait_for_response([ScrapeResponse.CATEGORICAL])
 
         variable_list = await self._get_all_variables()
-        while True:
-            current_variable = await self._get_current_variable()
-            self.logger.info(f'Processing variable {current_variable}')
-            await self._proccess_variable(requested_screen, pantalla_comunidad)
-            if current_variable not in variable_list:
-                raise ScrapeError(f"No se ha encontrado la variable {current_variable} en la lista {variable_list}")
-
-            self.logger.info(f'Pending variable {variable_list}')
-            variable_list.remove(current_variable)
-            if len(variable_list) == 0:
-                break
-
-            await self._select_variable(variable_list[0])
-            # self._reset_last_responses()
-            await self._wait_for_response([ScrapeResponse.SET_PARAM])
+        current_variable = await self._get_current_variable()
+        if current_variable not in variable_list:
+            raise ScrapeError(f"No se ha encontrado la variable {current_variable} en la lista {variable_list}")
+
+        # resume a retried job from the variables not processed yet
+        pending_variables = db.get_pending_variables(pantalla_comunidad, variable_list, self.current_provincia)
+        if len(pending_variables) < len(variable_list):
+            self.logger.info(f'Resuming with {len(pending_variables)} of {len(variable_list)} variables')
+        if current_variable in pending_variables:
+            # its responses are already here, no need to select it
+            pending_variables.remove(current_variable)
+            pending_variables.insert(0, current_variable)
+
+        for i, variable in enumerate(pending_variables):
+            self.logger.info(f'Pending variable {pending_variables[i:]}')
+            pantalla_comunidad_variable = db.get_or_create_pantalla_comunidad_variable(
+                pantalla_comunidad, variable, self.current_provincia
+            )
+            pantalla_comunidad_variable.set_en_curso(db.session)
+            db.session.commit()
+            try:
+                with metrics.tags(variable=variable), metrics.span("variable"):
+                    if variable != current_variable:
+                        await self._select_variable(variable)
+                        # self._reset_last_responses()
+                        await self._wait_for_response([ScrapeResponse.SET_PARAM])
+                        current_variable = await self._get_current_variable()
+                        if current_variable != variable:
+                            raise ScrapeError(f"Seleccionada la variable {variable} pero se muestra {current_variable}")
+
+                    self.logger.info(f'Processing variable {current_variable}')
+                    await self._proccess_variable(requested_screen, pantalla_comunidad)
+            except (ScrapeError, PlaywrightError) as error:
+                pantalla_comunidad_variable.set_error(db.session, str(error))
+                db.session.commit()
+                raise
 
     async def _check_new_data(self, page: Page) -> List[ScrapeResponse]:
         pages_found: List[ScrapeResponse] = []
 
-        while True:
-            response = await page.evaluate(
-                """() => {
-                    let elem = window.top.__responses.shift();
-                    if (elem) {
-                        return {responseText: elem.responseText, tipo: elem.tipo};
-                    }
-                    return null;
-                }"""
-            )
-
-            if response is None:
-                break
+        # take every pending response in a single round-trip
+        drained = await page.evaluate(
+            """() => {
+                const responses = window.top.__responses || [];
+                const dropped = window.top.__responsesDropped || 0;
+                window.top.__responses = [];
+                window.top.__responsesDropped = 0;
+                return {responses: responses, dropped: dropped};
+            }"""
+        )
+        if drained["dropped"] > 0:
+            self.logger.warning(f"{drained['dropped']} responses dropped in page, more than {MAX_PENDING_RESPONSES} pending")
 
+        for response in drained["responses"]:
             self.logger.info(f"Got {response['tipo']} from javascript")
             # scrape_response = ScrapeResponse.__members__.get(response['tipo'])
             scrape_response = ScrapeResponse.from_string(response['tipo'])
@@ -381,32 +651,56 @@ class Scraper:
                 })
 
                 pages_found.append(scrape_response)
-                if self.current_ccaa and self.current_screen:
-                    if self.modo_provincia:
-                        filename = self.cache_path / f'{self.current_ccaa}-{self.current_provincia}-{self.current_screen}-{response["tipo"]}.json'
-                    else:
-                        filename = self.cache_path / f'{self.current_ccaa}-{self.current_screen}-{response["tipo"]}.json'
-                    with open(filename, "w", encoding="utf-8") as file:
-                        file.write(response["responseText"])
-                        self.logger.info(f'Archivo {filename} escrito correctamente.')
+                content_hash = self.journal.response(
+                    response["tipo"],
+                    response["responseText"],
+                    ccaa=self.current_ccaa,
+                    provincia=self.current_provincia if self.modo_provincia else None,
+                    screen=self.current_screen,
+                    variable=self.selected_variable,
+                )
+                self.logger.info(f'Response {content_hash} guardada en la cache.')
 
         return pages_found
 
-    async def _wait_for_response(self, responses: List[ScrapeResponse], timeout: int = 120):
-        self.logger.info(f"Wait for responses {responses}")
+    def _on_response_captured(self, source, tipo: str):
+        self.logger.debug(f"Response {tipo} captured in page")
+        if self._response_event is not None:
+            self._response_event.set()
+
+    @metrics.timed("wait_for_response")
+    async def _wait_for_response(self, responses: List[ScrapeResponse], timeout: Optional[float] = None):
+        """Wait until every one of `responses` is captured, for `timeout` seconds or the learned timeout."""
+        # large comunidades take much longer than small ones on the same screen
+        operation = (f"response:{'+'.join(response.value for response in responses)}:"
+                     f"{self.current_screen}:{self.current_ccaa}")
+        if timeout is None:
+            timeout = self.timeouts.get(operation, RESPONSE_TIMEOUT)
+        self.logger.info(f"Wait for responses {responses} ({timeout:.1f} s)")
+        with self.timeouts.measure(operation, timeout):
+            await self._wait_for_pending_responses(responses, timeout)
+
+    async def _wait_for_pending_responses(self, responses: List[ScrapeResponse], timeout: float):
         pending_responses = responses.copy() #
-        start_time = asyncio.get_event_loop().time()  # Tiempo de inicio
-
-        while len(pending_responses) > 0:
-            # Verifica si el tiempo de espera ha superado el límite
-            elapsed_time = asyncio.get_event_loop().time() - start_time
-            if elapsed_time > timeout:
-                raise ScrapeTimeoutError(f"Timeout waiting for responses {timeout} seconds.")
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
 
-            await self.page.wait_for_timeout(3000)
+        while True:
             pages_found = await self._check_new_data(self.page)
             pending_responses = [item for item in pending_responses if item not in pages_found]
             self.logger.info(f"Pending responses {pending_responses}")
+            if len(pending_responses) == 0:
+                break
+
+            remaining_time = deadline - loop.time()
+            if remaining_time <= 0:
+                raise ScrapeTimeoutError(f"Timeout waiting for responses {pending_responses} {timeout:.1f} seconds.")
+
+            try:
+                await asyncio.wait_for(self._response_event.wait(), min(remaining_time, self.poll_interval))
+            except asyncio.TimeoutError:
+                pass
+            self._response_event.clear()
 
     async def get_current_screen(self) -> Optional[ScrapeScreen]:
         iframe = self._get_iframe_locator()
@@ -416,7 +710,7 @@ class Scraper:
         # print([texto.strip() for texto in textos])
 
         selector = iframe.locator('div#tabs div[wairole="presentation"][aria-selected="true"] > div[wairole="presentation"] > div[wairole="presentation"] > span')
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:current_screen")
         current_screen_name = await selector.text_content()
         current_tab = ScrapeTab.from_string(current_screen_name)
         if current_tab is None:
@@ -427,9 +721,15 @@ class Scraper:
     async def get_current_municipio(self) -> Optional[str]:
         iframe = self._get_iframe_locator()
         selector = iframe.locator('div.CategoricalFilterBox span.tabComboBox')
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:municipio")
         return await selector.text_content()
 
+    async def _wait_for_selector(self, locator: Locator, operation: str, default: float = SELECTOR_TIMEOUT):
+        """`locator.wait_for` with the learned timeout of `operation`, `default` seconds until there is one."""
+        timeout = self.timeouts.get(operation, default)
+        with self.timeouts.measure(operation, timeout):
+            await locator.wait_for(timeout=timeout * 1000)
+
     def _get_iframe_locator(self) -> FrameLocator:
         return self.page.frame_locator('div#embedded-viz-wrapper iframe')
 
@@ -437,10 +737,16 @@ class Scraper:
         self.last_responses_found = [
             item for item in self.last_responses_found if item["tipo"] == ScrapeResponse.INITIAL
         ]
+        self.workbook_state.reset()
+        self.journal.reset(keep_initial=True)
 
     def _reset_all_responses(self):
         self.last_responses_found = []
+        self.selected_variable = None
+        self.workbook_state.reset()
+        self.journal.reset(keep_initial=False)
 
+    @metrics.timed("move_to_screen")
     async def _move_to_screen(self, screen: ScrapeScreen):
         scrape_tab = screen.to_scrape_tab(self.modo_provincia)
         iframe = self._get_iframe_locator()
@@ -449,24 +755,25 @@ class Scraper:
             f' div[wairole="presentation"] > div[wairole="presentation"] > '
             f'span:has-text("{scrape_tab.value}")'
         )
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:screen_tab")
 
         parent_div = selector.locator('..')  # El doble punto (..) va al elemento padre en XPath
         await parent_div.click()
 
+    @metrics.timed("move_to_provincia")
     async def _move_to_provincia(self, provincia_codigo: str):
         iframe = self._get_iframe_locator()
         selector = iframe.locator('div.CategoricalFilterBox span.tabComboBox')
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:municipio")
         await selector.click()
         selector = iframe.locator('div.SearchBox textarea.QueryBox')
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:municipio_search")
         await selector.first.press('Control+A')
         await selector.first.press('Backspace')
         await selector.first.fill(provincia_codigo+'001')
 
         selector = iframe.locator(f'div[id*="Codigo Municipio"] a[title^="{provincia_codigo}001"]')
-        await selector.first.wait_for(timeout=10000)
+        await self._wait_for_selector(selector.first, "selector:municipio_result", 10)
         await selector.click()
 
         pass
@@ -490,9 +797,10 @@ class Scraper:
             'div.tabComboBoxMenu[role=menu][aria-label^="Inicia la navegación seleccionando una variable del este Bloque"]'
             ' div.tabMenuContent div.tabMenuItem span.tabMenuItemName'
         )
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:variable_menu")
         return selector
 
+    @metrics.timed("get_all_variables")
     async def _get_all_variables(self) -> List[str]:
         await self._click_on_variable()
         selector = await self._get_select_variables_node()
@@ -505,7 +813,7 @@ class Scraper:
         iframe = self._get_iframe_locator()
         try:
             selector = iframe.locator('div.tab-glass.clear-glass.tab-widget')
-            await selector.first.wait_for(timeout=5000)
+            await self._wait_for_selector(selector.first, "selector:variable_menu_glass")
             await selector.click()
         except Exception as ex:
             # self.logger.error(f'Error intentando cancelar la lista {ex}')
@@ -529,16 +837,16 @@ class Scraper:
             'div.ParameterControl h3[title^="Inicia la navegación seleccionando una variable del este Bloque"]'
         )
 
-        await selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(selector.first, "selector:variable_parameter")
 
         parameter_box_selector = selector.locator('xpath=ancestor::div[contains(@class, "ParameterControlBox")]')
-        await parameter_box_selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(parameter_box_selector.first, "selector:variable_parameter_box")
 
         variable_selector = parameter_box_selector.locator(
             'div.PCContent div.tabComboBoxNameContainer span.tabComboBoxName'
         )
 
-        await variable_selector.first.wait_for(timeout=5000)
+        await self._wait_for_selector(variable_selector.first, "selector:variable_name")
 
         return variable_selector.first
 
@@ -546,7 +854,9 @@ class Scraper:
         variable_selector = await self._select_variable_node()
         await variable_selector.first.click()
 
+    @metrics.timed("select_variable")
     async def _select_variable(self, variable: str):
+        self.selected_variable = variable
         await self._click_on_variable()
         selector = await self._get_select_variables_node()
         item = selector.filter(has_text=variable).first
@@ -558,7 +868,7 @@ class Scraper:
         await item.click()
 
         variable_selector = await self._select_variable_node()
-        await variable_selector.filter(has_text=variable).first.wait_for(state="visible", timeout=5000)
+        await self._wait_for_selector(variable_selector.filter(has_text=variable).first, "selector:variable_selected")
 
     async def _get_current_variable(self) -> str:
         variable_selector = await self._select_variable_node()
@@ -566,50 +876,91 @@ class Scraper:
 
     async def _proccess_variable(self, screen: ScrapeScreen, pantalla_comunidad: db.PantallaComunidad):
         current_variable = await self._get_current_variable()
-        ts = TableauScraper2(logLevel=logging.ERROR)
-        if len(self.last_responses_found) == 0:
+        self.journal.variable(
+            current_variable,
+            pantalla=pantalla_comunidad.pantalla.nombre,
+            comunidad=pantalla_comunidad.comunidad.codigo,
+            modo_provincia=self.modo_provincia,
+            provincia=self.current_provincia if self.modo_provincia else None,
+        )
+        self._process_responses(self.last_responses_found, screen, self.modo_provincia, pantalla_comunidad,
+                                current_variable, self.workbook_state,
+                                self.current_provincia if self.modo_provincia else None)
+
+    @classmethod
+    def _update_workbook(cls, state: WorkbookState, responses: List[dict]) -> TableauWorkbook:
+        """Bring `state` up to date with `responses`: only the ones not applied yet are loaded."""
+        logger = logging.getLogger(__name__)
+        if len(responses) == 0:
             raise ScrapeError(f'No responses got for tableau')
 
-        self.logger.info(f"Loading {self.last_responses_found[0]['tipo']} into tableau TS")
-        initial_responses = [response for response in self.last_responses_found
-            if response['tipo'] == ScrapeResponse.INITIAL]
-        if len(initial_responses) == 0:
-            raise ScrapeError(f"No se ha recibido ninguna response del tipo {ScrapeResponse.INITIAL}")
-
-        ts.loads2(initial_responses[0]['response'])
-        workbook = ts.getWorkbook()
-        # print(ts.parameters)
-        not_initial_responses = [response for response in self.last_responses_found
-            if response['tipo'] != ScrapeResponse.INITIAL]
-        for response in not_initial_responses:
-            self.logger.info(f"Loading {response['tipo']} into tableau TS")
+        if len(responses) < state.applied:
+            # the response list was reset without resetting the state
+            state.reset()
+
+        if not state.loaded:
+            logger.info(f"Loading {ScrapeResponse.INITIAL} into tableau TS")
+            initial_responses = [response for response in responses
+                if response['tipo'] == ScrapeResponse.INITIAL]
+            if len(initial_responses) == 0:
+                raise ScrapeError(f"No se ha recibido ninguna response del tipo {ScrapeResponse.INITIAL}")
+
+            state.load(initial_responses[0]['response'])
+            # print(ts.parameters)
+
+        for response in responses[state.applied:]:
+            if response['tipo'] == ScrapeResponse.INITIAL:
+                continue
+
+            logger.info(f"Loading {response['tipo']} into tableau TS")
             r = json.loads(response['response'])
             print(response['tipo'])
-            workbook.updateFullData(r)
-            new_workbook = dashboard.getWorksheetsCmdResponse(ts, r)
-            if len(new_workbook.worksheets) > 0 or response['tipo'] != ScrapeResponse.FIRST_RENDER:
-                workbook = new_workbook
+            state.apply(r, keep_if_empty=response['tipo'] != ScrapeResponse.FIRST_RENDER)
+        state.applied = len(responses)
+
+        return state.workbook
+
+    @classmethod
+    def _process_responses(
+            cls,
+            responses: List[dict],
+            screen: ScrapeScreen,
+            modo_provincia: bool,
+            pantalla_comunidad: db.PantallaComunidad,
+            current_variable: str,
+            state: Optional[WorkbookState] = None,
+            provincia: Optional[str] = None,
+            checkpoint: bool = True,
+    ):
+        """
+            Save `current_variable` from the captured responses. Used by the scraper and by the offline replay.
+            `state` is the workbook of the screen, kept between variables; without it the workbook is built
+            from scratch. `provincia` is the nombre of the provincia in provincial mode. With `checkpoint`
+            False (replay) only the values are saved, the variable isn't marked as verified.
+        """
+        workbook = cls._update_workbook(state if state is not None else WorkbookState(), responses)
 
         if len(workbook.worksheets) == 0:
             raise ScrapeNoWorksheetsAfterLoad(f'No se han encontrado worksheets')
 
         variable_processed = False
         for t in workbook.worksheets:
-            if t.name == screen.get_sheet_name(self.modo_provincia):
+            if t.name == screen.get_sheet_name(modo_provincia):
                 if len(t.getColumns()) == 0:
                     raise ScrapeNoWorksheetsAfterLoad(f'El worksheet configurado no tiene campos')
 
-                self._print_ws_info(t, False, screen.get_column_names(self.modo_provincia))
-                self._save_ws_info(pantalla_comunidad, current_variable, t, screen.get_column_names(self.modo_provincia))
+                cls._print_ws_info(t, False, screen.get_column_names(modo_provincia))
+                cls._save_ws_info(pantalla_comunidad, current_variable, t, screen.get_column_names(modo_provincia),
+                                  provincia, checkpoint)
                 variable_processed = True
             # else:
             #    self._save_ws_info(t, True)
 
         if not variable_processed:
             for t in workbook.worksheets:
-                self.logger.info(f"--->{t.name}")
-                if t.name == screen.get_sheet_name(self.modo_provincia):
-                    self._print_ws_info(t, False)
+                logging.getLogger(__name__).info(f"--->{t.name}")
+                if t.name == screen.get_sheet_name(modo_provincia):
+                    cls._print_ws_info(t, False)
             raise ScrapeNoVariableProcessed(f'No se ha podido procesar la variable {current_variable}')
 
     @classmethod
@@ -631,38 +982,63 @@ class Scraper:
             sys.stdout.flush()
 
     @classmethod
+    @metrics.timed("save_ws_info")
     def _save_ws_info(
             cls,
             pantalla_comunidad: db.PantallaComunidad,
             variable: str,
             ws: TableauWorksheet,
-            attrs: Optional[ColumnNames] = None
+            attrs: Optional[ColumnNames] = None,
+            provincia: Optional[str] = None,
+            checkpoint: bool = True,
     ):
-        for _, row in ws.data.iterrows():
-            label = row[attrs.get("label")]
-            municipio = fix_mojibake(row[attrs.get('municipio')])
-            db.update_or_create_pantalla_comunidad_data(
+        municipios = fix_mojibake_series(ws.data[attrs.get('municipio')]).tolist()
+        labels = ws.data[attrs.get("label")].tolist()
+        if not checkpoint:
+            # recorded values, not checked against the site: the checkpoint of the variable is left as is
+            db.bulk_upsert_pantalla_comunidad_data(
+                pantalla_comunidad.pantalla, pantalla_comunidad.comunidad, variable, municipios, labels
+            )
+            db.session.commit()
+            return
+
+        # hash of what is written, so a fix in the parsing rewrites the values it changes
+        payload_hash = cls._payload_hash(municipios, labels, [db.parse_valor(label) for label in labels])
+
+        pantalla_comunidad_variable = db.get_or_create_pantalla_comunidad_variable(
+            pantalla_comunidad, variable, provincia
+        )
+        if pantalla_comunidad_variable.hash == payload_hash:
+            logging.getLogger(__name__).info(f"Variable {variable} sin cambios, no se guarda")
+        else:
+            # whole columns at once, written with a single upsert per batch
+            db.bulk_upsert_pantalla_comunidad_data(
                 pantalla_comunidad.pantalla,
                 pantalla_comunidad.comunidad,
-                municipio,
                 variable,
-                label
+                municipios,
+                labels
             )
 
+        pantalla_comunidad_variable.set_verificado(db.session, payload_hash)
         db.session.commit()
 
+    @classmethod
+    def _payload_hash(cls, municipios: List, labels: List, valores: List) -> str:
+        return hashlib.sha256(json.dumps([municipios, labels, valores], default=str).encode("utf-8")).hexdigest()
+
+    @metrics.timed("switch_to_ccaa")
     async def _switch_to_ccaa(self):
         self._reset_all_responses()
         self.current_ccaa = "País Vasco"
         self.current_screen = ScrapeScreen.DEMOGRAFIA.value
         self.modo_provincia = False
         self.logger.info("Go to tableau main page CCAA .")
-        await self.page.goto(
-            "https://public.tableau.com/app/profile/reto.demografico/viz/SistemaIntegradodeDatosMunicipales2023/B1_Demogrfico_CCAA"
-        )
+        await self.page.goto(f"{self.base_url}{WORKBOOK_PATH}/{sheet_url_name(ScrapeTab.B1_DEMOGRAFICO_CCAA)}")
         await self._wait_for_response([ScrapeResponse.INITIAL, ScrapeResponse.FIRST_RENDER])
         self.logger.info("Initial responses ready!.")
 
+    @metrics.timed("switch_to_provincia")
     async def _switch_to_provincia(self):
         self._reset_all_responses()
         self.current_ccaa = "País Vasco"
@@ -670,29 +1046,31 @@ class Scraper:
         self.current_screen = ScrapeScreen.DEMOGRAFIA.value
         self.modo_provincia = True
         self.logger.info("Go to tableau main page provincia .")
-        await self.page.goto(
-            "https://public.tableau.com/app/profile/reto.demografico/viz/SistemaIntegradodeDatosMunicipales2023/B1_Demogrfico_Provincial"
-        )
+        await self.page.goto(f"{self.base_url}{WORKBOOK_PATH}/{sheet_url_name(ScrapeTab.B1_DEMOGRAFICO_PROVINCIAL)}")
         await self._wait_for_response([ScrapeResponse.INITIAL, ScrapeResponse.FIRST_RENDER])
         self.logger.info("Initial responses ready!.")
 
 
 INIT_SCRIPT = """//() => {
-    console.log("init");
+    const DEBUG = %DEBUG%;
+    // captured responses kept in the page until the scraper drains them
+    const MAX_PENDING = %MAX_PENDING%;
+    // only the requests to the viz host are captured
+    const CAPTURE_HOST = %CAPTURE_HOST%;
+    const debug = DEBUG ? console.log.bind(console) : function () {};
+
+    debug("init");
     var open = window.XMLHttpRequest.prototype.open;
-    window.top.__responses = [];
+    if (window.top.__responses === undefined) {
+        window.top.__responses = [];
+        window.top.__responsesDropped = 0;
+    }
 
     window.XMLHttpRequest.prototype.open = function (method, url, async, user, pass) {
-        console.log(url);
-        const validUrls = {
-            initial: 'bootstrapSession/sessions/',
-            first_render: '/notify-first-client-render-occurred',
-            set_param: '/set-parameter-value-from-index',
-            new_layout: '/ensure-layout-for-sheet',
-            categorical: '/categorical-filter-by-index'
-        };
+        debug(url);
+        const validUrls = %VALID_URLS%;
 
-        if (url.includes("public.tableau.com")) {
+        if (url.includes(CAPTURE_HOST)) {
             let keyFound = null;
             for (let key of Object.keys(validUrls)) {
                 if (url.includes(validUrls[key])) {
@@ -702,26 +1080,26 @@ INIT_SCRIPT = """//() => {
             }
 
             if (keyFound) {
-                console.log(url);
                 this.addEventListener("readystatechange", function () {
-                    console.log('ready state %s is %s', url, this.readyState);
+                    debug('ready state %s is %s', url, this.readyState);
                     if (this.readyState === 4) {
-                        console.log(window.__responses);
                         if (window.top.__responses === undefined) {
-                            console.log("undeffined!!!!");
                             window.top.__responses = [];
+                            window.top.__responsesDropped = 0;
+                        }
+                        if (window.top.__responses.length >= MAX_PENDING) {
+                            window.top.__responses.shift();
+                            window.top.__responsesDropped++;
                         }
-                        console.log(window.top.__responses);
 
                         window.top.__responses.push({
                             responseText: this.responseText,
-                            readyState: this.readyState,
-                            url: url,
-                            method: method,
                             tipo: keyFound,
                         });
-                        console.log("despues de añadir");
-                        console.log(window.top.__responses);
+                        debug("captured", keyFound, url);
+                        if (typeof window.__scraperNotify === "function") {
+                            window.__scraperNotify(keyFound);
+                        }
                     }
                 }, false);
             }
@@ -729,24 +1107,33 @@ INIT_SCRIPT = """//() => {
         open.apply(this, arguments);
     };
 
-    const originalFetch = window.fetch;
-    window.fetch = async function (...args) {
-        let input = args[0];
-        console.log(input);
-        console.log(input instanceof Request);
-        console.log(input.toString());
-        const url = input instanceof Request ? input.url : input.toString();
-
-        console.log(url);
-        if (url.includes('/categorical-filter-by-index')) {
-            console.log('Interceptando fetch:', args[0], args[1]);
-        }
+    if (DEBUG) {
+        const originalFetch = window.fetch;
+        window.fetch = async function (...args) {
+            let input = args[0];
+            const url = input instanceof Request ? input.url : input.toString();
+
+            debug(url);
+            const response = await originalFetch(...args);
+            if (url.includes('/categorical-filter-by-index')) {
+                debug('Respuesta de fetch:', await response.clone().json());
+            }
+            return response;
+        };
+    }
+
+//}"""
+
+# Responses kept in the page between two drains; beyond that the oldest ones are dropped
+MAX_PENDING_RESPONSES = 50
 
-        const response = await originalFetch(...args);
-        if (url.includes('/categorical-filter-by-index')) {
-            console.log('Respuesta de fetch:', await response.clone().json());
-        }
-        return response;
-    };
 
-//}"""
\ No newline at end of file
+def build_init_script(debug: bool = False, max_pending: int = MAX_PENDING_RESPONSES,
+                      capture_host: str = "public.tableau.com") -> str:
+    return (
+        INIT_SCRIPT
+        .replace("%VALID_URLS%", json.dumps({response.value: url for response, url in RESPONSE_URLS.items()}))
+        .replace("%CAPTURE_HOST%", json.dumps(capture_host))
+        .replace("%DEBUG%", "true" if debug else "false")
+        .replace("%MAX_PENDING%", str(max_pending))
+    )
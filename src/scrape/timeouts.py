@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Deque, Dict, Iterator, List, Optional
+
+# File of the cache directory with the latencies observed by previous runs
+TIMEOUTS_FILE = "timeouts.json"
+
+# Latencies kept per operation
+WINDOW = 200
+
+# Latencies needed before the timeout of an operation is derived from them
+MIN_SAMPLES = 20
+
+# The timeout is this quantile of the observed latencies times FACTOR, between MIN_TIMEOUT and
+# MAX_TIMEOUT seconds
+QUANTILE = 0.99
+FACTOR = 3.0
+MIN_TIMEOUT = 2.0
+MAX_TIMEOUT = 300.0
+
+# Each timeout of an operation multiplies its timeout by TIMEOUT_BUMP (up to MAX_BUMP, and never
+# past the hard-coded timeout of the operation), each success brings it back by BUMP_DECAY, so a
+# slow but healthy wait gets the time it needs and a stuck one still fails fast
+TIMEOUT_BUMP = 2.0
+MAX_BUMP = 8.0
+BUMP_DECAY = 0.9
+
+# A failed wait that lasted this share of its timeout or more timed out
+TIMED_OUT_RATIO = 0.95
+
+
+class AdaptiveTimeouts:
+    """
+        Timeouts learned from the latency of each operation (a response wait, a selector wait...).
+        Until an operation has MIN_SAMPLES latencies its hard-coded timeout is used. A wait that
+        times out is not a latency sample, it widens the timeout of the operation up to the
+        hard-coded one. The latencies are kept in a JSON file between runs.
+    """
+
+    def __init__(self, path: Optional[Path] = None, window: int = WINDOW, min_samples: int = MIN_SAMPLES,
+                 quantile: float = QUANTILE, factor: float = FACTOR, min_timeout: float = MIN_TIMEOUT,
+                 max_timeout: float = MAX_TIMEOUT):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.window = window
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.samples: Dict[str, Deque[float]] = {}
+        # latencies not saved yet, merged with the file on save (other processes write it too)
+        self.unsaved: Dict[str, List[float]] = {}
+        # multiplier of the timeout of the operations that timed out lately
+        self.bumps: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def get(self, operation: str, default: float) -> float:
+        """Timeout of `operation` in seconds. `default` is its hard-coded timeout."""
+        samples = self.samples.get(operation)
+        if samples is None or len(samples) < self.min_samples:
+            return default
+
+        ordered = sorted(samples)
+        observed = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+        timeout = min(self.max_timeout, max(self.min_timeout, observed * self.factor))
+        bump = self.bumps.get(operation)
+        if bump is not None:
+            timeout = max(timeout, min(timeout * bump, default))
+        return timeout
+
+    def observe(self, operation: str, seconds: float):
+        with self.lock:
+            samples = self.samples.get(operation)
+            if samples is None:
+                samples = self.samples[operation] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self.unsaved.setdefault(operation, []).append(seconds)
+
+    @contextmanager
+    def measure(self, operation: str, timeout: float) -> Iterator[None]:
+        """
+            Record the latency of the block, run with `timeout` seconds. If it fails after (almost)
+            all of them it timed out: nothing is recorded and the timeout is widened.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            elapsed = time.perf_counter() - start
+            if elapsed >= timeout * TIMED_OUT_RATIO:
+                # get() keeps the widened timeout under the hard-coded one
+                self.bumps[operation] = min(MAX_BUMP, self.bumps.get(operation, 1.0) * TIMEOUT_BUMP)
+                self.logger.info(f"{operation} timed out after {elapsed:.1f} s, "
+                                 f"timeout widened x{self.bumps[operation]:.2f}")
+            raise
+
+        self.observe(operation, time.perf_counter() - start)
+        if operation in self.bumps:
+            self.bumps[operation] *= BUMP_DECAY
+            if self.bumps[operation] <= 1.0:
+                del self.bumps[operation]
+
+    def load(self):
+        for operation, latencies in self._read().items():
+            self.samples[operation] = deque(latencies, maxlen=self.window)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            if not self.unsaved:
+                return
+            stored = self._read()
+            for operation, latencies in self.unsaved.items():
+                stored[operation] = (stored.get(operation, []) + latencies)[-self.window:]
+            self.unsaved = {}
+
+            os.makedirs(self.path.parent, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump({operation: [round(latency, 4) for latency in latencies]
+                           for operation, latencies in sorted(stored.items())}, file, indent=1)
+            os.replace(tmp_path, self.path)
+
+        for operation, latencies in stored.items():
+            self.samples[operation] = deque(latencies, maxlen=self.window)
+
+    def _read(self) -> Dict[str, List[float]]:
+        if self.path is None or not self.path.is_file():
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as error:
+            self.logger.warning(f"Can't read the timeouts in {self.path}: {error}")
+            return {}
+
+
+_shared: Dict[Path, AdaptiveTimeouts] = {}
+
+
+def shared(cache_path: Path) -> AdaptiveTimeouts:
+    """The timeouts of a cache directory, one instance for every scraper of the process."""
+    path = Path(cache_path).resolve() / TIMEOUTS_FILE
+    if path not in _shared:
+        _shared[path] = AdaptiveTimeouts(path)
+    return _shared[path]
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+from bs4 import BeautifulSoup
+
+from db import db
+from scrape import timeouts
+from scrape.exception import ScrapeError, ScrapeTimeoutError
+from scrape.cache import CacheStore
+from scrape.journal import ResponseJournal
+from scrape.scrape import Scraper, ScrapeResponse, ScrapeScreen, RESPONSE_URLS, RecoveryTier, RECOVERY_METRIC, \
+    BASE_URL, sheet_url_name
+from tableau.tableau_utils import TableauScraper2, WorkbookState
+from utils import metrics
+
+VIZ_PATH = "/views/SistemaIntegradodeDatosMunicipales2023"
+
+VIZ_URL = f"{BASE_URL}{VIZ_PATH}"
+
+# Caption of the parameter control used to pick the variable shown in the map
+VARIABLE_PARAMETER_CAPTION = "Inicia la navegación seleccionando una variable"
+
+# Caption of the categorical filter used to move to a municipio (and so to its provincia)
+MUNICIPIO_FILTER_CAPTION = "Codigo Municipio"
+
+
+def viz_url(base_url: str = BASE_URL) -> str:
+    return f"{base_url.rstrip('/')}{VIZ_PATH}"
+
+
+class VizqlSession:
+    """
+        A VizQL session opened over plain HTTP, issuing the same commands the viz sends
+        when the user clicks on it. Every method returns the raw response text.
+    """
+
+    def __init__(self, http: aiohttp.ClientSession, viz_url: str = VIZ_URL, timeout: float = 120,
+                 adaptive_timeouts: Optional[timeouts.AdaptiveTimeouts] = None, scope: Optional[str] = None):
+        self.http = http
+        self.viz_url = viz_url.rstrip("/")
+        # seconds, for the requests with no learned timeout in `adaptive_timeouts` and cap of the widened ones
+        self.timeout = timeout
+        self.adaptive_timeouts = adaptive_timeouts or timeouts.AdaptiveTimeouts()
+        # what the requests are learned for besides the command and the sheet (the comunidad)
+        self.scope = scope
+        self.host: Optional[str] = None
+        self.sheet: Optional[str] = None
+        self.tableau_data: dict = {}
+
+    async def bootstrap(self, sheet: str) -> str:
+        self.sheet = sheet
+        url = f"{self.viz_url}/{sheet}"
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with self.http.get(url, params={":embed": "y", ":showVizHome": "no"}, timeout=timeout) as response:
+            response.raise_for_status()
+            html = await response.text()
+
+        config = BeautifulSoup(html, "html.parser").find("textarea", {"id": "tsConfigContainer"})
+        if config is None:
+            raise ScrapeError(f"No tsConfigContainer found in {url}")
+
+        self.tableau_data = json.loads(config.text)
+        uri = urlparse(url)
+        self.host = f"{uri.scheme}://{uri.netloc}"
+
+        return await self._post(
+            f'{self.host}{self.tableau_data["vizql_root"]}/{RESPONSE_URLS[ScrapeResponse.INITIAL]}'
+            f'{self.tableau_data["sessionid"]}',
+            {
+                "sheet_id": self.tableau_data["sheetId"],
+                "clientDimension": json.dumps({"w": 1920, "h": 1080}),
+            },
+            ScrapeResponse.INITIAL,
+        )
+
+    async def set_parameter_from_index(self, parameter_name: str, index: int) -> str:
+        return await self._command(ScrapeResponse.SET_PARAM, [
+            ("globalFieldName", parameter_name),
+            ("valueIndex", str(index)),
+        ])
+
+    async def categorical_filter_by_index(self, worksheet: str, dashboard: str, global_field_name: str,
+                                          indices: List[int]) -> str:
+        return await self._command(ScrapeResponse.CATEGORICAL, [
+            ("visualIdPresModel", json.dumps({"worksheet": worksheet, "dashboard": dashboard})),
+            ("globalFieldName", global_field_name),
+            ("membershipTarget", "filter"),
+            ("filterIndices", json.dumps(indices)),
+            ("filterUpdateType", "filter-replace"),
+        ])
+
+    async def _command(self, command: ScrapeResponse, fields: Sequence[Tuple[str, str]]) -> str:
+        if self.host is None:
+            raise ScrapeError("VizQL session not bootstrapped")
+
+        form = aiohttp.FormData()
+        for name, value in fields:
+            form.add_field(name, value)
+
+        return await self._post(
+            f'{self.host}{self.tableau_data["vizql_root"]}/sessions/{self.tableau_data["sessionid"]}'
+            f'/commands/tabdoc{RESPONSE_URLS[command]}',
+            form,
+            command,
+        )
+
+    @metrics.timed("vizql_request")
+    async def _post(self, url: str, data, command: ScrapeResponse) -> str:
+        operation = f"vizql:{command.value}:{self.sheet}:{self.scope}"
+        timeout = self.adaptive_timeouts.get(operation, self.timeout)
+        try:
+            with self.adaptive_timeouts.measure(operation, timeout):
+                async with self.http.post(url, data=data, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()
+                    return await response.text()
+        except aiohttp.ServerTimeoutError as error:
+            raise ScrapeTimeoutError(f"Timeout in {url}: {error}")
+        except asyncio.TimeoutError:
+            raise ScrapeTimeoutError(f"Timeout in {url} after {timeout:.1f} seconds")
+        except aiohttp.ClientError as error:
+            raise ScrapeError(f"Error in {url}: {error}")
+
+
+class HttpScraper:
+    """
+        Browserless scraper: same interface as `Scraper`, but each job opens a VizQL session
+        for the sheet of its screen and selects every variable by index. The responses go
+        through the same `Scraper._process_responses` path and are recorded in the journal.
+    """
+
+    def __init__(self, cache_path: str = "./.cache", viz_url: str = VIZ_URL):
+        self.logger = logging.getLogger(__name__)
+        self.viz_url = viz_url
+        self.http: Optional[aiohttp.ClientSession] = None
+        self.page = None
+        self.cache_path = Path(cache_path)
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.journal = ResponseJournal(CacheStore(self.cache_path))
+        self.timeouts = timeouts.shared(self.cache_path)
+
+    async def start(self, browser=None):
+        self.http = aiohttp.ClientSession()
+
+    async def finalize(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    async def recover(self) -> RecoveryTier:
+        """There is no page to re-sync: just open a new HTTP session."""
+        await self.finalize()
+        await self.start()
+        metrics.registry.inc(RECOVERY_METRIC, tier=RecoveryTier.NEW_CONTEXT.value)
+        return RecoveryTier.NEW_CONTEXT
+
+    def transition_cost(self, pantalla_comunidad: db.PantallaComunidad) -> int:
+        # every job opens its own session: all of them cost the same
+        return 0
+
+    async def screenshot(self, path: str, full_page: bool = False):
+        raise ScrapeError("HttpScraper has no page")
+
+    async def scrape(self, pantalla_comunidad: db.PantallaComunidad, provincia: Optional[db.Provincia] = None):
+        with metrics.tags(provincia=provincia.nombre if provincia else None), metrics.span("scrape"):
+            try:
+                await self._scrape(pantalla_comunidad, provincia)
+            finally:
+                self.timeouts.save()
+
+    async def _scrape(self, pantalla_comunidad: db.PantallaComunidad, provincia: Optional[db.Provincia] = None):
+        screen = ScrapeScreen.from_string(pantalla_comunidad.pantalla.nombre)
+        if screen is None:
+            raise ScrapeError(f"Unkown requested screen {pantalla_comunidad.pantalla.nombre}")
+
+        modo_provincia = provincia is not None
+        if provincia is None:
+            provincia = pantalla_comunidad.comunidad.get_provincia_capital()
+            if provincia is None:
+                raise ScrapeError(f"Cant find capital for comunidad {pantalla_comunidad.comunidad.nombre}")
+
+        context = {
+            "ccaa": pantalla_comunidad.comunidad.nombre,
+            "provincia": provincia.nombre if modo_provincia else None,
+            "screen": screen.value,
+        }
+        responses: List[dict] = []
+        state = WorkbookState()
+
+        def add_response(tipo: ScrapeResponse, text: str, variable: Optional[str] = None):
+            responses.append({'tipo': tipo, 'response': text})
+            self.journal.response(tipo.value, text, variable=variable, **context)
+
+        session = VizqlSession(self.http, self.viz_url, adaptive_timeouts=self.timeouts,
+                               scope=pantalla_comunidad.comunidad.nombre)
+        self.journal.reset(keep_initial=False)
+        add_response(ScrapeResponse.INITIAL, await session.bootstrap(sheet_url_name(screen.to_scrape_tab(modo_provincia))))
+        state.load(responses[0]['response'])
+        state.applied = 1
+        ts = state.ts
+
+        worksheet, municipio_filter = self._find_municipio_filter(ts)
+        municipio_index = next(
+            (i for i, value in enumerate(municipio_filter["values"]) if str(value).startswith(f"{provincia.codigo}001")),
+            None
+        )
+        if municipio_index is None:
+            raise ScrapeError(f"Municipio {provincia.codigo}001 not found in filter {municipio_filter['column']}")
+
+        add_response(ScrapeResponse.CATEGORICAL, await session.categorical_filter_by_index(
+            worksheet, municipio_filter.get("dashboard", ts.dashboard), municipio_filter["globalFieldName"],
+            [municipio_index]
+        ))
+
+        parameter = self._find_variable_parameter(ts)
+        variable_list = list(parameter["values"])
+        # resume a retried job from the variables not processed yet
+        pending_variables = db.get_pending_variables(pantalla_comunidad, variable_list, context["provincia"])
+        if len(pending_variables) < len(variable_list):
+            self.logger.info(f'Resuming with {len(pending_variables)} of {len(variable_list)} variables')
+
+        for variable in pending_variables:
+            pantalla_comunidad_variable = db.get_or_create_pantalla_comunidad_variable(
+                pantalla_comunidad, variable, context["provincia"]
+            )
+            pantalla_comunidad_variable.set_en_curso(db.session)
+            db.session.commit()
+            try:
+                with metrics.tags(variable=variable), metrics.span("variable"):
+                    self.logger.info(f'Processing variable {variable}')
+                    # the parameter is set by its index in the domain, not in the pending variables
+                    add_response(ScrapeResponse.SET_PARAM, await session.set_parameter_from_index(
+                        parameter["parameterName"], variable_list.index(variable)
+                    ), variable)
+                    self.journal.variable(
+                        variable,
+                        pantalla=pantalla_comunidad.pantalla.nombre,
+                        comunidad=pantalla_comunidad.comunidad.codigo,
+                        modo_provincia=modo_provincia,
+                        provincia=context["provincia"],
+                    )
+                    Scraper._process_responses(responses, screen, modo_provincia, pantalla_comunidad, variable, state,
+                                               context["provincia"])
+            except ScrapeError as error:
+                pantalla_comunidad_variable.set_error(db.session, str(error))
+                db.session.commit()
+                raise
+
+    @classmethod
+    def _find_variable_parameter(cls, ts: TableauScraper2) -> dict:
+        for parameter in ts.parameters:
+            if parameter["column"].startswith(VARIABLE_PARAMETER_CAPTION):
+                return parameter
+
+        raise ScrapeError(f"No parameter '{VARIABLE_PARAMETER_CAPTION}' in {[p['column'] for p in ts.parameters]}")
+
+    @classmethod
+    def _find_municipio_filter(cls, ts: TableauScraper2) -> Tuple[str, dict]:
+        for worksheet, filters in ts.filters.items():
+            for municipio_filter in filters:
+                if MUNICIPIO_FILTER_CAPTION in municipio_filter["column"]:
+                    return worksheet, municipio_filter
+
+        raise ScrapeError(f"No filter '{MUNICIPIO_FILTER_CAPTION}' found")
@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import random
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from scrape.cache import CacheStore
+from scrape.journal import read_response
+from scrape.scrape import RESPONSE_URLS, ScrapeResponse, ScrapeScreen, ScrapeTab, WORKBOOK_PATH, sheet_url_name
+from scrape.vizql import VARIABLE_PARAMETER_CAPTION, VIZ_PATH, HttpScraper
+from tableau.tableau_utils import TableauScraper2
+
+DEFAULT_PORT = 8765
+
+# Tabs of the viz, in the order they are shown, for the CCAA and the provincial views
+CCAA_TABS = [screen.to_scrape_tab(False) for screen in ScrapeScreen]
+PROVINCIA_TABS = [screen.to_scrape_tab(True) for screen in ScrapeScreen]
+
+
+class RecordedViz:
+    """
+        Responses of the cache, by tab: the bootstrap, first render, layout and categorical filter
+        responses (the first recorded of each) and the set-parameter response of every variable.
+        Every session of a tab gets the same data, whatever comunidad or provincia it asks for.
+    """
+
+    def __init__(self, store: CacheStore):
+        self.logger = logging.getLogger(__name__)
+        self.store = store
+        self.responses: Dict[ScrapeTab, Dict[ScrapeResponse, dict]] = {}
+        self.set_param: Dict[ScrapeTab, Dict[str, dict]] = {}
+        self.variables: Dict[ScrapeTab, List[str]] = {}
+
+        for entry in store.entries():
+            screen = ScrapeScreen.from_string(entry.get("screen") or entry.get("pantalla") or "")
+            if screen is None:
+                continue
+
+            if entry["event"] == "variable":
+                tab = screen.to_scrape_tab(entry["modo_provincia"])
+                variables = self.variables.setdefault(tab, [])
+                if entry["variable"] not in variables:
+                    variables.append(entry["variable"])
+            elif entry["event"] == "response":
+                tipo = ScrapeResponse.from_string(entry["tipo"])
+                tab = screen.to_scrape_tab(entry.get("provincia") is not None)
+                if tipo == ScrapeResponse.SET_PARAM and entry.get("variable"):
+                    self.set_param.setdefault(tab, {}).setdefault(entry["variable"], entry)
+                elif tipo is not None:
+                    self.responses.setdefault(tab, {}).setdefault(tipo, entry)
+
+        # the menu lists the variables in the order of the parameter, the index sent when one is selected
+        for tab in self.tabs:
+            values = self._parameter_values(tab)
+            if values:
+                self.variables[tab] = values
+
+    @property
+    def tabs(self) -> List[ScrapeTab]:
+        return [tab for tab in self.responses if ScrapeResponse.INITIAL in self.responses[tab]]
+
+    def _parameter_values(self, tab: ScrapeTab) -> Optional[List[str]]:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                ts = TableauScraper2()
+                ts.loads2(self.response(tab, ScrapeResponse.INITIAL))
+            return [str(value) for value in HttpScraper._find_variable_parameter(ts)["values"]]
+        except Exception as error:
+            self.logger.warning(f"Variables of {tab.value} not found in its bootstrap response: {error}")
+            return None
+
+    def initial_variable(self, tab: ScrapeTab) -> Optional[str]:
+        """The variable shown when the tab loads: the one processed without being selected."""
+        variables = self.variables.get(tab, [])
+        selected = self.set_param.get(tab, {})
+        return next((variable for variable in variables if variable not in selected), variables[0] if variables else None)
+
+    def response(self, tab: ScrapeTab, tipo: ScrapeResponse) -> Optional[str]:
+        entry = self.responses.get(tab, {}).get(tipo)
+        return read_response(self.store, entry) if entry is not None else None
+
+    def set_param_response(self, tab: ScrapeTab, index: int) -> Optional[str]:
+        variables = self.variables.get(tab, [])
+        if not 0 <= index < len(variables):
+            return None
+        entry = self.set_param.get(tab, {}).get(variables[index])
+        return read_response(self.store, entry) if entry is not None else None
+
+
+class StandinServer:
+    """
+        Local stand-in for the Tableau Public viz: a minimal embedding page with the controls the
+        Scraper clicks (tabs, municipio filter, variable parameter) and the VizQL endpoints, which
+        answer with the recorded responses after `latency` (+ up to `jitter`) seconds.
+    """
+
+    def __init__(self, viz: RecordedViz, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.logger = logging.getLogger(__name__)
+        self.viz = viz
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        # tab shown by each VizQL session
+        self.sessions: Dict[str, ScrapeTab] = {}
+        self.tabs_by_url = {sheet_url_name(tab): tab for tab in ScrapeTab}
+        self.requests = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get(f"{WORKBOOK_PATH}/{{sheet}}", self.embedding_page)
+        app.router.add_get(f"{VIZ_PATH}/{{sheet}}", self.viz_page)
+        app.router.add_post("/vizql/{workbook}/bootstrapSession/sessions/{session}", self.bootstrap)
+        app.router.add_post("/vizql/{workbook}/sessions/{session}/commands/tabdoc/{command}", self.command)
+        return app
+
+    def _tab(self, request: web.Request) -> ScrapeTab:
+        tab = self.tabs_by_url.get(request.match_info["sheet"])
+        if tab is None:
+            raise web.HTTPNotFound(text=f"Unknown sheet {request.match_info['sheet']}")
+        return tab
+
+    async def embedding_page(self, request: web.Request) -> web.Response:
+        sheet = request.match_info["sheet"]
+        return web.Response(content_type="text/html", text=EMBEDDING_PAGE.replace(
+            "%VIZ_URL%", f"{VIZ_PATH}/{sheet}?:embed=y&:showVizHome=no"
+        ))
+
+    async def viz_page(self, request: web.Request) -> web.Response:
+        tab = self._tab(request)
+        session_id = uuid.uuid4().hex.upper()
+        self.sessions[session_id] = tab
+        tabs = PROVINCIA_TABS if tab in PROVINCIA_TABS else CCAA_TABS
+        config = {
+            "vizql_root": "/vizql/SistemaIntegradodeDatosMunicipales2023",
+            "sessionid": session_id,
+            "sheetId": tab.value,
+        }
+        data = {
+            "tabs": [tab.value for tab in tabs],
+            "variables": {tab.value: self.viz.variables.get(tab, []) for tab in tabs},
+            "initial": {tab.value: self.viz.initial_variable(tab) for tab in tabs},
+            "parameterCaption": VARIABLE_PARAMETER_CAPTION,
+        }
+        return web.Response(content_type="text/html", text=(
+            VIZ_PAGE
+            .replace("%CONFIG%", _html_escape(json.dumps(config)))
+            .replace("%DATA%", json.dumps(data).replace("</", "<\\/"))
+        ))
+
+    async def bootstrap(self, request: web.Request) -> web.Response:
+        tab = self.sessions.get(request.match_info["session"])
+        return await self._reply(tab, ScrapeResponse.INITIAL, tab and self.viz.response(tab, ScrapeResponse.INITIAL))
+
+    async def command(self, request: web.Request) -> web.Response:
+        session_id = request.match_info["session"]
+        tab = self.sessions.get(session_id)
+        command = f'/{request.match_info["command"]}'
+        form = await request.post()
+
+        if command == RESPONSE_URLS[ScrapeResponse.NEW_LAYOUT]:
+            tab = ScrapeTab.from_string(form.get("targetSheet", "")) or tab
+            self.sessions[session_id] = tab
+            return await self._reply(tab, ScrapeResponse.NEW_LAYOUT, self.viz.response(tab, ScrapeResponse.NEW_LAYOUT))
+        if command == RESPONSE_URLS[ScrapeResponse.SET_PARAM]:
+            index = int(form.get("valueIndex", -1))
+            return await self._reply(tab, ScrapeResponse.SET_PARAM, tab and self.viz.set_param_response(tab, index))
+
+        for tipo in (ScrapeResponse.FIRST_RENDER, ScrapeResponse.CATEGORICAL):
+            if command == RESPONSE_URLS[tipo]:
+                return await self._reply(tab, tipo, tab and self.viz.response(tab, tipo))
+
+        raise web.HTTPNotFound(text=f"Unknown command {command}")
+
+    async def _reply(self, tab: Optional[ScrapeTab], tipo: ScrapeResponse, text: Optional[str]) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        if text is None:
+            self.logger.warning(f"No {tipo.value} response recorded for {tab.value if tab else 'unknown session'}")
+            raise web.HTTPNotFound(text=f"No {tipo.value} response recorded")
+        return web.Response(content_type="text/plain", text=text)
+
+
+def _html_escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+async def start_server(viz: RecordedViz, host: str = "127.0.0.1", port: int = DEFAULT_PORT, latency: float = 0.0,
+                       jitter: float = 0.0, seed: int = 0) -> web.AppRunner:
+    """Start the stand-in in the running event loop. Stop it with `await runner.cleanup()`."""
+    runner = web.AppRunner(StandinServer(viz, latency, jitter, seed).app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+EMBEDDING_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>SistemaIntegradodeDatosMunicipales2023 (stand-in)</title></head>
+<body style="margin: 0">
+<div id="embedded-viz-wrapper">
+    <iframe src="%VIZ_URL%" style="width: 1200px; height: 900px; border: 0"></iframe>
+</div>
+</body>
+</html>
+"""
+
+VIZ_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+    .tab { display: inline-block; padding: 4px 8px; cursor: pointer; }
+    .tab[aria-selected="true"] { font-weight: bold; }
+    .tab-glass { position: fixed; inset: 0; z-index: 1; }
+    .tabComboBoxMenu { position: absolute; left: 0; top: 0; width: 300px; z-index: 2; background: white; }
+    .tabMenuItem { padding: 2px 4px; cursor: pointer; }
+</style>
+</head>
+<body>
+<textarea id="tsConfigContainer" style="display: none">%CONFIG%</textarea>
+<div id="tabs"></div>
+<div class="CategoricalFilterBox"><span class="tabComboBox">01001</span></div>
+<div class="SearchBox" style="display: none">
+    <textarea class="QueryBox"></textarea>
+    <div id="filter_Codigo Municipio"></div>
+</div>
+<div class="ParameterControlBox">
+    <div class="ParameterControl">
+        <h3></h3>
+        <div class="PCContent"><div class="tabComboBoxNameContainer"><span class="tabComboBoxName"></span></div></div>
+    </div>
+</div>
+<div id="menu"></div>
+<script>
+    const config = JSON.parse(document.getElementById("tsConfigContainer").value);
+    const data = %DATA%;
+    let currentTab = config.sheetId;
+    let currentVariable = data.initial[currentTab];
+
+    function post(path, fields, done) {
+        const xhr = new XMLHttpRequest();
+        xhr.open("POST", location.origin + path);
+        xhr.onload = function () { if (done) { done(xhr.responseText); } };
+        const form = new FormData();
+        for (const key of Object.keys(fields)) { form.append(key, fields[key]); }
+        xhr.send(form);
+    }
+
+    function command(name, fields, done) {
+        post(`${config.vizql_root}/sessions/${config.sessionid}/commands/tabdoc/${name}`, fields, done);
+    }
+
+    function render() {
+        const tabs = document.getElementById("tabs");
+        tabs.innerHTML = "";
+        for (const name of data.tabs) {
+            const tab = document.createElement("div");
+            tab.className = "tab";
+            tab.setAttribute("wairole", "presentation");
+            tab.setAttribute("aria-selected", name === currentTab ? "true" : "false");
+            tab.innerHTML = '<div wairole="presentation"><div wairole="presentation"><span></span></div></div>';
+            tab.querySelector("span").textContent = name;
+            tab.addEventListener("click", function () { selectTab(name); });
+            tabs.appendChild(tab);
+        }
+        document.querySelector(".ParameterControl h3").title = data.parameterCaption + " de este Bloque";
+        document.querySelector(".ParameterControl h3").textContent = data.parameterCaption;
+        document.querySelector(".tabComboBoxName").textContent = currentVariable || "";
+    }
+
+    function selectTab(name) {
+        if (name === currentTab) { return; }
+        currentTab = name;
+        currentVariable = data.initial[name];
+        command("ensure-layout-for-sheet", {targetSheet: name}, function () {
+            render();
+            command("notify-first-client-render-occurred", {});
+        });
+    }
+
+    function closeMenu() { document.getElementById("menu").innerHTML = ""; }
+
+    function openMenu() {
+        const menu = document.getElementById("menu");
+        if (menu.innerHTML !== "") { closeMenu(); return; }
+        const glass = document.createElement("div");
+        glass.className = "tab-glass clear-glass tab-widget";
+        glass.addEventListener("click", closeMenu);
+        const list = document.createElement("div");
+        list.className = "tabComboBoxMenu";
+        list.setAttribute("role", "menu");
+        list.setAttribute("aria-label", data.parameterCaption + " de este Bloque");
+        const content = document.createElement("div");
+        content.className = "tabMenuContent";
+        (data.variables[currentTab] || []).forEach(function (variable, index) {
+            const item = document.createElement("div");
+            item.className = "tabMenuItem";
+            item.innerHTML = '<span class="tabMenuItemName"></span>';
+            item.querySelector("span").textContent = variable;
+            item.addEventListener("click", function () { selectVariable(variable, index); });
+            content.appendChild(item);
+        });
+        list.appendChild(content);
+        menu.appendChild(glass);
+        menu.appendChild(list);
+    }
+
+    function selectVariable(variable, index) {
+        closeMenu();
+        currentVariable = variable;
+        render();
+        command("set-parameter-value-from-index", {globalFieldName: "[Parameters].[Variable]", valueIndex: index});
+    }
+
+    document.querySelector(".tabComboBoxName").addEventListener("click", openMenu);
+
+    document.querySelector(".CategoricalFilterBox .tabComboBox").addEventListener("click", function () {
+        document.querySelector(".SearchBox").style.display = "block";
+    });
+
+    document.querySelector(".QueryBox").addEventListener("input", function (event) {
+        const value = event.target.value.trim();
+        const results = document.getElementById("filter_Codigo Municipio");
+        results.innerHTML = "";
+        if (value === "") { return; }
+        const link = document.createElement("a");
+        link.title = value;
+        link.textContent = value;
+        link.href = "#";
+        link.addEventListener("click", function (clickEvent) {
+            clickEvent.preventDefault();
+            document.querySelector(".SearchBox").style.display = "none";
+            document.querySelector(".CategoricalFilterBox .tabComboBox").textContent = value;
+            command("categorical-filter-by-index", {filterIndices: "[0]", filterUpdateType: "filter-replace"});
+        });
+        results.appendChild(link);
+    });
+
+    post(`${config.vizql_root}/bootstrapSession/sessions/${config.sessionid}`, {sheet_id: config.sheetId}, function () {
+        render();
+        command("notify-first-client-render-occurred", {});
+    });
+</script>
+</body>
+</html>
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the recorded viz responses as a local Tableau stand-in")
+    parser.add_argument("--cache", default="./.cache", help="cache directory with the recorded responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every VizQL response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency, up to these seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the jitter, for repeatable runs")
+    return parser.parse_args()
+
+
+async def serve(args):
+    viz = RecordedViz(CacheStore(Path(args.cache)))
+    logging.info(f"Recorded tabs: {[tab.value for tab in viz.tabs]}")
+    runner = await start_server(viz, args.host, args.port, args.latency, args.jitter, args.seed)
+    logging.info(f"Stand-in listening on http://{args.host}:{args.port}, run main.py --base-url http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    asyncio.run(serve(parse_args()))
@@ -1,20 +1,57 @@
 import json
-from tableauscraper import TableauScraper as TS, utils, TableauWorkbook
+import logging
+from typing import List, Optional
+
+from tableauscraper import TableauScraper as TS, utils, TableauWorkbook, dashboard
 from tableauscraper.TableauScraper import TableauException
-import re
+
+from utils import metrics
+
+
+_decoder = json.JSONDecoder()
+
+# digits of the length prefix of each frame
+MAX_LENGTH_PREFIX = 20
+
+
+def parse_framed_response(r: str, frames: int = 2) -> List[dict]:
+    """
+        Parse a bootstrapSession response, `<len>;<json><len>;<json>`, reading the framing directly:
+        each json is decoded in place from its offset (no regex backtracking over the whole
+        response, no copies of the payloads) and the declared lengths, in characters, are used to
+        detect truncated responses.
+    """
+    result = []
+    pos = 0
+    for _ in range(frames):
+        separator = r.find(";", pos, pos + MAX_LENGTH_PREFIX + 1)
+        length_prefix = r[pos:separator].strip() if separator != -1 else ""
+        if not length_prefix.isdigit():
+            raise TableauException(message="Error parsing data")
+
+        length = int(length_prefix)
+        start = separator + 1
+        if start + length > len(r):
+            raise TableauException(
+                message=f"Truncated response: frame of {length} declared, {len(r) - start} received")
+
+        try:
+            obj, pos = _decoder.raw_decode(r, start)
+        except json.JSONDecodeError as error:
+            raise TableauException(message=f"Error parsing data: {error}")
+
+        result.append(obj)
+        while pos < len(r) and r[pos].isspace():
+            pos += 1
+
+    return result
 
 
 class TableauScraper2(TS):
     def loads2(self, r):
         try:
             # dataReg = re.search(r"\d+;({.*})\d+;({.*})", r, re.MULTILINE)
-            data_reg = re.search(r"\d+;({.*})\d+;({.*})", r, re.DOTALL)
-
-            if data_reg is None:
-                raise TableauException(message="Error parsing data")
-
-            self.info = json.loads(data_reg.group(1))
-            self.data = json.loads(data_reg.group(2))
+            self.info, self.data = parse_framed_response(r)
             # self.dashboard_filter = self.getDashBoardFilter(self.info)
 
             if "presModelMap" in self.data["secondaryInfo"]:
@@ -59,3 +96,43 @@ class TableauScraper2(TS):
                     pres_model_map_viz_info, worksheet)
                 filter_result[worksheet] = selected_filters
         return filter_result
+
+
+class WorkbookState:
+    """
+        Workbook of the screen being scraped. The bootstrap response is parsed once and then
+        every command response is applied on top of it as it arrives, so the cost of each
+        update doesn't depend on how many responses came before.
+    """
+
+    def __init__(self):
+        self.ts: Optional[TableauScraper2] = None
+        self.workbook: Optional[TableauWorkbook] = None
+        # number of responses of the scraper response list already applied
+        self.applied = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.ts is not None
+
+    def reset(self):
+        self.ts = None
+        self.workbook = None
+        self.applied = 0
+
+    @metrics.timed("loads2")
+    def load(self, bootstrap_response: str):
+        self.ts = TableauScraper2(logLevel=logging.ERROR)
+        self.ts.loads2(bootstrap_response)
+        self.workbook = self.ts.getWorkbook()
+
+    @metrics.timed("update_full_data")
+    def apply(self, cmd_response: dict, keep_if_empty: bool = True):
+        """
+            Update the data dictionary with a command response and take its worksheets.
+            With keep_if_empty=False a response without worksheets doesn't replace the current ones.
+        """
+        self.workbook.updateFullData(cmd_response)
+        new_workbook = dashboard.getWorksheetsCmdResponse(self.ts, cmd_response)
+        if len(new_workbook.worksheets) > 0 or keep_if_empty:
+            self.workbook = new_workbook
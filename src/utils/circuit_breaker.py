@@ -0,0 +1,128 @@
+import asyncio
+import enum
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Optional
+
+from utils import metrics
+
+# Times the breaker opened (or opened again after a failed probe)
+OPEN_METRIC = "scraper_circuit_open_total"
+
+# Outcomes looked at to compute the error rate
+WINDOW = 20
+
+# Outcomes needed before the breaker can open
+MIN_CALLS = 5
+
+# Error rate of the window that opens the breaker
+THRESHOLD = 0.5
+
+# Seconds the breaker stays open, doubled every time the probe fails, up to MAX_COOLDOWN
+COOLDOWN = 60
+MAX_COOLDOWN = 900
+
+# Seconds between checks of the workers waiting for the probe
+PROBE_POLL_INTERVAL = 1
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+
+class CircuitBreaker:
+    """
+        Shared by the workers of the process. Every job outcome is recorded; when the error rate
+        of the last `window` jobs reaches `threshold` the breaker opens and `wait` holds every
+        worker for `cooldown` seconds. Then a single job (the probe) is let through: if it works
+        the breaker closes, otherwise it opens again with twice the cooldown.
+        With `load_open_until` / `save_open_until` (see db.get_circuit_open_until) the open state is
+        shared with the other processes: any of them opening the breaker holds the workers of all.
+        The error rate is still computed per process.
+    """
+
+    def __init__(self, window: int = WINDOW, min_calls: int = MIN_CALLS, threshold: float = THRESHOLD,
+                 cooldown: float = COOLDOWN, max_cooldown: float = MAX_COOLDOWN,
+                 load_open_until: Optional[Callable[[], Optional[datetime]]] = None,
+                 save_open_until: Optional[Callable[[datetime], None]] = None):
+        self.logger = logging.getLogger(__name__)
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.state = CircuitState.CLOSED
+        self.opened_until = 0.0
+        self.load_open_until = load_open_until
+        self.save_open_until = save_open_until
+
+    @property
+    def closed(self) -> bool:
+        return self.state == CircuitState.CLOSED
+
+    async def wait(self):
+        """Return once the worker can start a job: right away unless the breaker is open (here or in another process)."""
+        while True:
+            if self.state == CircuitState.CLOSED:
+                remaining = self._shared_remaining()
+                if remaining <= 0:
+                    return
+                self.logger.warning(f"Circuit opened by another process, waiting {remaining:.0f} s")
+                self.state = CircuitState.OPEN
+                self.opened_until = time.monotonic() + remaining
+
+            remaining = self.opened_until - time.monotonic()
+            if self.state == CircuitState.OPEN and remaining <= 0:
+                self.logger.info("Circuit half open, letting a job through")
+                self.state = CircuitState.HALF_OPEN
+                return
+
+            # open: until the cooldown ends, half open: until the probe finishes
+            await asyncio.sleep(remaining if self.state == CircuitState.OPEN else PROBE_POLL_INTERVAL)
+
+    def record(self, success: bool):
+        if self.state == CircuitState.HALF_OPEN:
+            if success:
+                self.logger.info("Probe job succeeded, circuit closed")
+                self.state = CircuitState.CLOSED
+                self.cooldown = self.base_cooldown
+                self.outcomes.clear()
+            else:
+                self._open(min(self.max_cooldown, self.cooldown * 2), "probe job failed")
+            return
+
+        self.outcomes.append(success)
+        if len(self.outcomes) < self.min_calls:
+            return
+
+        error_rate = self.outcomes.count(False) / len(self.outcomes)
+        if error_rate >= self.threshold:
+            self._open(self.cooldown, f"error rate {error_rate:.0%} in the last {len(self.outcomes)} jobs")
+
+    def release(self):
+        """The probe let through by `wait` found no job to run: the next worker to wait takes its place."""
+        if self.state == CircuitState.HALF_OPEN:
+            self.state = CircuitState.OPEN
+            self.opened_until = time.monotonic()
+
+    def _open(self, cooldown: float, reason: str):
+        self.logger.warning(f"Circuit open for {cooldown:.0f} s: {reason}")
+        metrics.registry.inc(OPEN_METRIC)
+        self.state = CircuitState.OPEN
+        self.cooldown = cooldown
+        self.opened_until = time.monotonic() + cooldown
+        self.outcomes.clear()
+        if self.save_open_until is not None:
+            self.save_open_until(datetime.utcnow() + timedelta(seconds=cooldown))
+
+    def _shared_remaining(self) -> float:
+        """Seconds the breaker of the other processes stays open."""
+        if self.load_open_until is None:
+            return 0.0
+        open_until = self.load_open_until()
+        return (open_until - datetime.utcnow()).total_seconds() if open_until is not None else 0.0
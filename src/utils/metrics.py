@@ -0,0 +1,235 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+# Histogram of the duration of every phase of the scrape, labelled by phase and tags
+PHASE_METRIC = "scraper_phase_seconds"
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Labels with too many values for Prometheus (one series each): the .prom file aggregates them
+# away, they are only kept in the JSON summary
+PROMETHEUS_EXCLUDED_LABELS = ("variable",)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Tags (pantalla, comunidad, provincia, variable) of the job being run by the current task
+_tags: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("metrics_tags", default={})
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        # observations per bucket (not cumulative), the last one is +Inf
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def merge(self, other: "Histogram"):
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, other.bucket_counts)]
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile (the max for the +Inf bucket)."""
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+        In-process histograms and counters. Phases are timed with `span` (or `timed`) and get
+        the tags set with `tags` by the task running them. The registry is written as a
+        Prometheus text file and a JSON summary with `write`.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, _labels(labels))] += value
+
+    @contextmanager
+    def span(self, phase: str, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(PHASE_METRIC, time.perf_counter() - start, phase=phase, **{**_tags.get(), **labels})
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+    def to_prometheus(self) -> str:
+        """Every series without the PROMETHEUS_EXCLUDED_LABELS, the ones differing only in them merged."""
+        histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        for (name, labels), histogram in self.histograms.items():
+            key = (name, _prometheus_labels(labels))
+            if key not in histograms:
+                histograms[key] = Histogram(histogram.buckets)
+            histograms[key].merge(histogram)
+
+        counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        for (name, labels), value in self.counters.items():
+            counters[(name, _prometheus_labels(labels))] += value
+
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        """Totals per phase, to see at a glance where the time goes, and every labelled series."""
+        phases: Dict[str, dict] = {}
+        series = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            label_dict = dict(labels)
+            summary = {
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "max": histogram.max,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+            }
+            series.append({"metric": name, "labels": label_dict, **summary})
+
+            if name == PHASE_METRIC:
+                phase = phases.setdefault(label_dict["phase"], {"count": 0, "sum": 0.0, "max": 0.0})
+                phase["count"] += histogram.count
+                phase["sum"] += histogram.sum
+                phase["max"] = max(phase["max"], histogram.max)
+
+        for phase in phases.values():
+            phase["mean"] = phase["sum"] / phase["count"] if phase["count"] else 0.0
+
+        return {
+            "phases": dict(sorted(phases.items(), key=lambda item: -item[1]["sum"])),
+            "counters": [
+                {"metric": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "series": series,
+        }
+
+    def write(self, metrics_path: Path, name: Optional[str] = None):
+        """Write <name>.prom and <name>.json (one pair per process by default) in `metrics_path`."""
+        name = name or f"scraper-{os.getpid()}"
+        os.makedirs(metrics_path, exist_ok=True)
+        _write_atomic(Path(metrics_path) / f"{name}.prom", self.to_prometheus())
+        _write_atomic(Path(metrics_path) / f"{name}.json", json.dumps(self.to_json(), indent=2, ensure_ascii=False))
+
+
+registry = Metrics()
+
+
+@contextmanager
+def tags(**values) -> Iterator[None]:
+    """Tag the spans run inside the block (and in the tasks it creates). None values are ignored."""
+    token = _tags.set({**_tags.get(), **{key: str(value) for key, value in values.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def span(phase: str, **labels):
+    return registry.span(phase, **labels)
+
+
+def timed(phase: str):
+    """Decorator version of `span`, for plain and async functions."""
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with registry.span(phase):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with registry.span(phase):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _prometheus_labels(labels: Labels) -> Labels:
+    return tuple((key, value) for key, value in labels if key not in PROMETHEUS_EXCLUDED_LABELS)
+
+
+def _format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _write_atomic(path: Path, content: str):
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(tmp_path, path)
@@ -1,3 +1,18 @@
+import math
+import re
+from functools import lru_cache
+from typing import Iterable, Optional, Tuple
+
+import pandas as pd
+
+# Distinct names kept by the mojibake repair cache (municipios of every screen fit many times)
+MOJIBAKE_CACHE_SIZE = 65536
+
+# A UTF-8 lead byte followed by a continuation byte, both read as cp1252: "Ã©" for "é", "â€™" for "’"
+_MOJIBAKE_RE = re.compile(
+    "[\u00c2-\u00f4][\u0080-\u00bf\u0152\u0153\u0160\u0161\u0178\u017d\u017e\u0192\u02c6\u02dc"
+    "\u2013-\u203a\u20ac\u2122]"
+)
 
 
 def fix_mojibake(text: str) -> str:
@@ -14,3 +29,55 @@ def fix_mojibake(text: str) -> str:
         return text  # ya está bien
     except UnicodeDecodeError:
         return text  # ya está bien
+
+
+@lru_cache(maxsize=MOJIBAKE_CACHE_SIZE)
+def _fix_mojibake_cached(text: str) -> str:
+    return fix_mojibake(text)
+
+
+def has_mojibake(values: Iterable) -> bool:
+    """True if any of the values looks like UTF-8 text decoded as cp1252."""
+    return any(isinstance(value, str) and _MOJIBAKE_RE.search(value) for value in values)
+
+
+def fix_mojibake_series(series: pd.Series, detect: bool = True) -> pd.Series:
+    """
+        fix_mojibake for a whole column: each distinct value is repaired once (and remembered
+        across calls). With `detect`, a column without mojibake is returned as is.
+    """
+    uniques = series.dropna().unique()
+    if detect and not has_mojibake(uniques):
+        return series
+
+    repaired = {value: _fix_mojibake_cached(value) for value in uniques if isinstance(value, str)}
+    fixed = series.map(repaired)
+    return fixed.where(fixed.notna(), series)
+
+
+# First number of a label, Spanish format: 1.234.567,89
+_NUMBER_RE = re.compile(r"[-+]?\d{1,3}(?:\.\d{3})+(?:,\d+)?|[-+]?\d+(?:,\d+)?")
+
+
+def parse_valor(label) -> Tuple[Optional[float], Optional[str]]:
+    """
+        Numeric value and unit of a Tableau label: "1.234,5 hab." -> (1234.5, "hab."),
+        "12,3 %" -> (12.3, "%"). (None, None) if the label has no number in that format.
+    """
+    if label is None:
+        return None, None
+    if isinstance(label, (int, float)):
+        return (None, None) if math.isnan(label) else (float(label), None)
+
+    match = _NUMBER_RE.search(str(label))
+    if match is None:
+        return None, None
+
+    rest = str(label)[match.end():]
+    if rest[:1].isdigit() or rest[:1] in (".", ","):
+        # not a Spanish formatted number ("1.23", "2.5"): better no valor_num than a wrong one
+        return None, None
+
+    number = float(match.group(0).replace(".", "").replace(",", "."))
+    unidad = rest.strip()
+    return number, unidad or None
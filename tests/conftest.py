@@ -0,0 +1,44 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# the modules of the scraper are imported as in src/main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# the db module opens its database when imported: not ./database.db, every test gets its own below
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+
+def _bind_database(monkeypatch, url: str):
+    """Point the engine and session of the db module to a new database with the comunidades and pantallas."""
+    from db import db
+    from db.utils import insert_all_pantallas, insert_all_provincias
+
+    engine = db.create_sqlite_engine(url)
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "session", scoped_session(sessionmaker(bind=engine), scopefunc=db._session_scope))
+    db.Base.metadata.create_all(engine)
+    insert_all_provincias()
+    insert_all_pantallas()
+    return db, engine
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """The db module on an in-memory SQLite, for what only goes through db.session."""
+    db, engine = _bind_database(monkeypatch, "sqlite://")
+    yield db
+    db.session.remove()
+    engine.dispose()
+
+
+@pytest.fixture
+def file_db(monkeypatch, tmp_path):
+    """The db module on a WAL database file, for the compare-and-set updates run on their own connections."""
+    db, engine = _bind_database(monkeypatch, f"sqlite:///{tmp_path / 'test.db'}")
+    yield db
+    db.session.remove()
+    engine.dispose()
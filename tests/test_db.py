@@ -0,0 +1,242 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+
+def pending_jobs(db, count: int = 1):
+    """Leave the first `count` jobs pending and every other one processed."""
+    jobs = db.session.query(db.PantallaComunidad).order_by(db.PantallaComunidad.id).limit(count).all()
+    db.session.query(db.PantallaComunidad).update({db.PantallaComunidad.estado: db.Estado.PROCESADO})
+    for job in jobs:
+        job.estado = db.Estado.PENDIENTE
+    db.session.commit()
+    return jobs
+
+
+def verify(db, job, variable: str, provincia=None):
+    db.get_or_create_pantalla_comunidad_variable(job, variable, provincia).set_verificado(db.session, variable)
+    db.session.commit()
+
+
+def data(db, variable: str) -> dict:
+    db.session.expire_all()
+    return {
+        row.municipio.nombre: row
+        for row in db.session.query(db.PantallaComunidadData).join(db.Variable).filter(db.Variable.nombre == variable)
+    }
+
+
+def test_get_or_create_municipios(memory_db):
+    db = memory_db
+    comunidad = db.get_comunidades()[0]
+    ids = db.get_or_create_municipios(comunidad, ["Uno", "Dos", "Uno"])
+    assert set(ids) == {"Uno", "Dos"}
+
+    again = db.get_or_create_municipios(comunidad, ["Dos", "Tres"])
+    assert again["Dos"] == ids["Dos"]
+    assert len(set(again.values())) == 3
+
+
+def test_bulk_upsert(memory_db):
+    db = memory_db
+    job = db.session.query(db.PantallaComunidad).first()
+    sent = db.bulk_upsert_pantalla_comunidad_data(
+        job.pantalla, job.comunidad, "Población", ["Uno", "Dos", "Tres"], ["1.000", "2.000", "3,5 %"], batch_size=2
+    )
+    db.session.commit()
+    assert sent == 3
+    rows = data(db, "Población")
+    assert {nombre: (row.valor, row.valor_num, row.unidad) for nombre, row in rows.items()} == {
+        "Uno": ("1.000", 1000.0, None),
+        "Dos": ("2.000", 2000.0, None),
+        "Tres": ("3,5 %", 3.5, "%"),
+    }
+
+    fecha = datetime.utcnow() - timedelta(days=1)
+    db.session.query(db.PantallaComunidadData).update({db.PantallaComunidadData.fecha_descarga: fecha})
+    db.session.commit()
+    db.bulk_upsert_pantalla_comunidad_data(
+        job.pantalla, job.comunidad, "Población", ["Uno", "Dos", "Tres"], ["1.000", "2.500", "3,5 %"]
+    )
+    db.session.commit()
+
+    rows = data(db, "Población")
+    assert db.session.query(db.PantallaComunidadData).count() == 3
+    # only the changed valor is written
+    assert (rows["Dos"].valor, rows["Dos"].valor_num) == ("2.500", 2500.0)
+    assert rows["Dos"].fecha_descarga > fecha
+    assert rows["Uno"].fecha_descarga == fecha
+    assert rows["Tres"].fecha_descarga == fecha
+
+
+def test_bulk_upsert_empty(memory_db):
+    job = memory_db.session.query(memory_db.PantallaComunidad).first()
+    assert memory_db.bulk_upsert_pantalla_comunidad_data(job.pantalla, job.comunidad, "Vacía", [], []) == 0
+
+
+def test_claim_is_exclusive(file_db):
+    db = file_db
+    first, second = pending_jobs(db, 2)
+
+    claimed = {db.claim_pending_pantalla("a").id, db.claim_pending_pantalla("b").id}
+    assert claimed == {first.id, second.id}
+    assert db.claim_pending_pantalla("c") is None
+
+
+def test_lease_compare_and_set(file_db):
+    db = file_db
+    pending_jobs(db)
+    job = db.claim_pending_pantalla("a", lease_seconds=60)
+
+    assert db.heartbeat_pantalla(job.id, "a")
+    assert not db.heartbeat_pantalla(job.id, "b")
+    assert not db.set_pantalla_procesada(job, "b")
+    assert not db.set_pantalla_error(job, "b", "error")
+    assert job.estado == db.Estado.EN_CURSO
+
+    assert db.set_pantalla_procesada(job, "a")
+    assert job.estado == db.Estado.PROCESADO
+    assert job.lease_owner is None
+    # finished: the lease can't be extended any more
+    assert not db.heartbeat_pantalla(job.id, "a")
+
+
+def test_expired_lease_is_reclaimed(file_db):
+    db = file_db
+    pending_jobs(db)
+    job = db.claim_pending_pantalla("a", lease_seconds=60)
+    assert db.claim_pending_pantalla("b") is None
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            db.update(db.PantallaComunidad).where(db.PantallaComunidad.id == job.id)
+            .values(lease_expira=datetime.utcnow() - timedelta(seconds=1))
+        )
+    reclaimed = db.claim_pending_pantalla("b")
+    assert reclaimed.id == job.id
+    assert reclaimed.lease_owner == "b"
+    # the old owner can't finish it any more
+    assert not db.set_pantalla_procesada(job, "a")
+
+
+@pytest.mark.parametrize("interrupt", ["error", "release"])
+def test_checkpoints_resume(file_db, interrupt):
+    db = file_db
+    pending_jobs(db)
+    job = db.claim_pending_pantalla("a")
+    verify(db, job, "v1")
+    verify(db, job, "v1", provincia="Araba")
+
+    if interrupt == "error":
+        assert db.set_pantalla_error(job, "a", "error")
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.update(db.PantallaComunidad).where(db.PantallaComunidad.id == job.id).values(next_attempt_at=None)
+            )
+    else:
+        db.release_pantalla(job.id, "a")
+
+    resumed = db.claim_pending_pantalla("b")
+    assert resumed.id == job.id
+    assert db.get_pending_variables(resumed, ["v1", "v2"]) == ["v2"]
+    assert db.get_pending_variables(resumed, ["v1", "v2"], "Araba") == ["v2"]
+    assert db.get_pending_variables(resumed, ["v1", "v2"], "Gipuzkoa") == ["v1", "v2"]
+
+
+def test_checkpoints_reset_on_new_run(file_db):
+    db = file_db
+    pending_jobs(db)
+    job = db.claim_pending_pantalla("a")
+    verify(db, job, "v1")
+    assert db.set_pantalla_procesada(job, "a")
+
+    # a refresh sets the job pending again: a new run
+    job.estado = db.Estado.PENDIENTE
+    db.session.commit()
+    rerun = db.claim_pending_pantalla("a")
+    assert db.get_pending_variables(rerun, ["v1", "v2"]) == ["v1", "v2"]
+
+
+def test_retry_delay():
+    from db import db
+    for error_count in range(1, db.MAX_ATTEMPTS + 1):
+        delay = min(db.RETRY_MAX_SECONDS, db.RETRY_BASE_SECONDS * 2 ** (error_count - 1))
+        for _ in range(20):
+            assert delay / 2 <= db.retry_delay(error_count) <= delay
+    # the longest backoff is reached before the attempts run out
+    assert db.RETRY_BASE_SECONDS * 2 ** (db.MAX_ATTEMPTS - 2) >= db.RETRY_MAX_SECONDS
+
+
+def test_retry_backoff(file_db):
+    db = file_db
+    pending_jobs(db)
+    job = db.claim_pending_pantalla("a")
+    before = datetime.utcnow()
+    assert db.set_pantalla_error(job, "a", "error")
+    assert job.estado == db.Estado.ERROR
+    assert job.error_count == 1
+    assert before + timedelta(seconds=db.RETRY_BASE_SECONDS / 2) <= job.next_attempt_at
+    assert db.get_next_attempt() == job.next_attempt_at
+    # not claimable until its retry
+    assert db.claim_pending_pantalla("a") is None
+
+
+def test_retry_not_counted(file_db):
+    db = file_db
+    pending_jobs(db)
+    job = db.claim_pending_pantalla("a")
+    assert db.set_pantalla_error(job, "a", "error", count_attempt=False)
+    assert job.error_count == 0
+    assert job.next_attempt_at > datetime.utcnow()
+
+
+def test_attempts_run_out(file_db):
+    db = file_db
+    job, = pending_jobs(db)
+    job.estado = db.Estado.ERROR
+    job.error_count = db.MAX_ATTEMPTS
+    db.session.commit()
+    assert db.claim_pending_pantalla("a") is None
+    assert db.get_next_attempt() is None
+
+
+def legacy_table(db, rows):
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            f'CREATE TABLE "{db.LEGACY_DATA_TABLE}" (id INTEGER PRIMARY KEY, id_pantalla INTEGER, '
+            f'id_comunidad INTEGER, municipio TEXT, nombre TEXT, valor TEXT, fecha_descarga DATETIME)'
+        ))
+        conn.execute(text(
+            f'INSERT INTO "{db.LEGACY_DATA_TABLE}" (id_pantalla, id_comunidad, municipio, nombre, valor, fecha_descarga) '
+            f'VALUES (:id_pantalla, :id_comunidad, :municipio, :nombre, :valor, :fecha_descarga)'
+        ), rows)
+
+
+def test_migrate_legacy_data(file_db):
+    db = file_db
+    job = db.session.query(db.PantallaComunidad).first()
+    fecha = datetime(2024, 1, 1)
+    legacy_table(db, [
+        {"id_pantalla": job.pantalla.id, "id_comunidad": job.comunidad.id, "municipio": municipio,
+         "nombre": nombre, "valor": valor, "fecha_descarga": fecha}
+        for municipio, nombre, valor in [
+            ("Uno", "Población", "1.000"), ("Dos", "Población", "2,5 %"), ("Uno", "Paro", "Sin datos"),
+        ]
+    ])
+    assert db.has_legacy_data()
+
+    assert db.migrate_legacy_data(batch_size=2)
+    assert not db.has_legacy_data()
+    # renamed, not dropped
+    assert db.inspect(db.engine).has_table(db.LEGACY_BACKUP_TABLE)
+
+    poblacion = data(db, "Población")
+    assert {nombre: (row.valor, row.valor_num, row.unidad) for nombre, row in poblacion.items()} == {
+        "Uno": ("1.000", 1000.0, None),
+        "Dos": ("2,5 %", 2.5, "%"),
+    }
+    assert data(db, "Paro")["Uno"].valor_num is None
+
+    # already migrated
+    assert not db.migrate_legacy_data()
@@ -0,0 +1,77 @@
+import json
+import os
+import re
+from pathlib import Path
+
+import pytest
+from tableauscraper.TableauScraper import TableauException
+
+from tableau.tableau_utils import parse_framed_response
+
+# cache recorded by the scraper, used when present (SCRAPER_CACHE overrides it)
+CACHE_PATH = Path(os.environ.get("SCRAPER_CACHE", Path(__file__).resolve().parent.parent / ".cache"))
+
+INFO = {"sheetName": "B1 Demográfico CCAA", "worldUpdate": {"applicationPresModel": {}}}
+DATA = {"secondaryInfo": {"presModelMap": {"municipios": ["Álava", "A Coruña", "Castelló/Castellón", "Ñoño €"]}}}
+
+
+def frame(obj: dict) -> str:
+    payload = json.dumps(obj, ensure_ascii=False)
+    return f"{len(payload)};{payload}"
+
+
+def parse_regex(r: str):
+    """The parsing replaced by parse_framed_response."""
+    data_reg = re.search(r"\d+;({.*})\d+;({.*})", r, re.MULTILINE)
+    return [json.loads(data_reg.group(1)), json.loads(data_reg.group(2))]
+
+
+def bootstrap_responses():
+    if not (CACHE_PATH / "manifest.jsonl").is_file():
+        return [pytest.param(None, marks=pytest.mark.skip(reason=f"no recorded responses in {CACHE_PATH}"))]
+
+    from scrape.cache import CacheStore
+    from scrape.journal import read_response
+
+    store = CacheStore(CACHE_PATH)
+    responses = [
+        pytest.param(read_response(store, entry), id=entry["hash"][:12])
+        for entry in store.entries(event="response", tipo="initial")
+    ]
+    return responses or [pytest.param(None, marks=pytest.mark.skip(reason=f"no bootstrap responses in {CACHE_PATH}"))]
+
+
+def test_multibyte_payloads():
+    assert parse_framed_response(frame(INFO) + frame(DATA)) == [INFO, DATA]
+
+
+def test_whitespace_between_frames():
+    assert parse_framed_response(frame(INFO) + "\n" + frame(DATA)) == [INFO, DATA]
+
+
+def test_truncated_second_frame():
+    response = frame(INFO) + frame(DATA)
+    with pytest.raises(TableauException, match="Truncated"):
+        parse_framed_response(response[:-10])
+
+
+@pytest.mark.parametrize("prefix", ["", "abc", "-5", "1" * 30])
+def test_bad_length_prefix(prefix):
+    payload = json.dumps(INFO)
+    with pytest.raises(TableauException):
+        parse_framed_response(f"{prefix};{payload}" + frame(DATA))
+
+
+def test_invalid_json():
+    with pytest.raises(TableauException):
+        parse_framed_response("5;{abc}" + frame(DATA))
+
+
+def test_regex_parity():
+    response = frame(INFO) + frame(DATA)
+    assert parse_framed_response(response) == parse_regex(response)
+
+
+@pytest.mark.parametrize("response", bootstrap_responses())
+def test_cached_bootstrap(response):
+    assert parse_framed_response(response) == parse_regex(response)
@@ -0,0 +1,52 @@
+import math
+
+import pandas as pd
+import pytest
+
+from utils.text_utils import fix_mojibake, fix_mojibake_series, has_mojibake, parse_valor
+
+
+@pytest.mark.parametrize("label, expected", [
+    ("1.234,5 hab.", (1234.5, "hab.")),
+    ("12,3 %", (12.3, "%")),
+    ("1.234.567", (1234567.0, None)),
+    ("-3,25 €", (-3.25, "€")),
+    ("42", (42.0, None)),
+    (7, (7.0, None)),
+    (2.5, (2.5, None)),
+    # dot decimals are not the Spanish format: no valor_num rather than a wrong one
+    ("1.23", (None, None)),
+    ("2.5 km", (None, None)),
+    ("Sin datos", (None, None)),
+    ("", (None, None)),
+    (None, (None, None)),
+    (math.nan, (None, None)),
+])
+def test_parse_valor(label, expected):
+    assert parse_valor(label) == expected
+
+
+def mojibake(text: str) -> str:
+    return text.encode("utf-8").decode("cp1252")
+
+
+def test_fix_mojibake():
+    assert fix_mojibake(mojibake("Cádiz")) == "Cádiz"
+    assert fix_mojibake(mojibake("Castelló/Castellón")) == "Castelló/Castellón"
+    # already right, or not cp1252 at all
+    assert fix_mojibake("Álava") == "Álava"
+    assert fix_mojibake("Ōsaka") == "Ōsaka"
+
+
+def test_fix_mojibake_series():
+    series = pd.Series([mojibake("A Coruña"), "Madrid", None, mojibake("León")])
+    fixed = fix_mojibake_series(series)
+    assert fixed.tolist()[:2] == ["A Coruña", "Madrid"]
+    assert fixed[2] is None
+    assert fixed[3] == "León"
+
+
+def test_fix_mojibake_series_without_mojibake():
+    series = pd.Series(["Álava", "Cádiz"])
+    assert not has_mojibake(series)
+    assert fix_mojibake_series(series) is series